@@ -42,8 +42,11 @@ from fastcore.basics import (
 )
 from fastcore.foundation import L
 from fastcore.meta import funcs_kwargs
+from fastcore.xtras import is_listy
+import torch
+from torch import Tensor
 
-from ..utils import defaults, find_bs, noop, tensor, to_concat
+from ..utils import defaults, find_bs, tensor, to_concat, to_detach
 
 # Cell
 # nbdev_comment _all_ = ['CancelStepException','CancelFitException','CancelEpochException','CancelTrainException','CancelValidException','CancelBatchException']
@@ -68,7 +71,9 @@ event.__module__ = "fastai_minima.callback"
 # nbdev_comment _all_ = ['event']
 
 # Cell
-_inner_loop = "before_batch after_pred after_loss before_backward before_step after_step after_cancel_batch after_batch".split()
+_inner_loop = frozenset(
+    "before_batch after_pred after_loss before_backward before_step after_step after_cancel_batch after_batch".split()
+)
 
 # Cell
 @funcs_kwargs(as_method=True)
@@ -82,33 +87,59 @@ class Callback(Stateful, GetAttr):
         True,
         True,
     )
-    _methods = _events
+    _methods, _xtra = _events, None
 
     def __init__(self, **kwargs):
         assert not kwargs, f"Passed unknown events: {kwargs}"
 
+    def __getattr__(self, k):
+        # Same as `GetAttr.__getattr__`, with `_xtra` as a class attribute so it's not looked up
+        # through `__getattr__` itself each time an attribute of the learner is needed
+        if k.startswith("__") or k == self._default:
+            raise AttributeError(k)
+        if self._xtra is not None and k not in self._xtra:
+            raise AttributeError(k)
+        attr = getattr(self, self._default, None)
+        if attr is None:
+            raise AttributeError(k)
+        return getattr(attr, k)
+
     def __repr__(self):
         return type(self).__name__
 
     def __call__(self, event_name):
         "Call `self.{event_name}` if it's defined"
-        _run = (
-            event_name not in _inner_loop
-            or (self.run_train and getattr(self, "training", True))
+        if not self.run:
+            if event_name == "after_fit":
+                self.run = True  # Reset self.run to True at each end of fit
+            return
+        if event_name in _inner_loop and not (
+            (self.run_train and getattr(self, "training", True))
             or (self.run_valid and not getattr(self, "training", False))
-        )
-        res = None
-        if self.run and _run:
-            res = getattr(self, event_name, noop)()
-        if event_name == "after_fit":
-            self.run = True  # Reset self.run to True at each end of fit
-        return res
+        ):
+            return
+        # Events passed to `__init__` are bound on the instance and take precedence
+        f = self.__dict__.get(event_name)
+        if f is not None:
+            return f()
+        # Looked up on the class at each call (not through the learner by `__getattr__`), so
+        # methods added or replaced later with `@patch` are picked up
+        f = getattr(type(self), event_name, None)
+        if f is not None:
+            return f(self)
 
     def __setattr__(self, name, value):
-        if hasattr(self.learn, name):
-            warn(
-                f"You are shadowing an attribute ({name}) that exists in the learner. Use `self.learn.{name}` to avoid this"
-            )
+        if name == "learn":
+            # Names already checked for shadowing an attribute of the learner: the lookup through
+            # the learner (and the model) is done once per name, not at each assignment
+            self.__dict__["_shadow_checked"] = set()
+        elif self.learn is not None:
+            checked = self.__dict__.setdefault("_shadow_checked", set())
+            if name not in checked and hasattr(self.learn, name):
+                warn(
+                    f"You are shadowing an attribute ({name}) that exists in the learner. Use `self.learn.{name}` to avoid this"
+                )
+            checked.add(name)
         super().__setattr__(name, value)
 
     @property
@@ -129,19 +160,22 @@ class TrainEvalCallback(Callback):
         "Set the iter and epoch counters to 0, put the model and the right device"
         self.learn.epoch, self.learn.loss = 0, tensor(0.0)
         self.learn.train_iter, self.learn.pct_train = 0, 0.0
-        if hasattr(self.dls, "device"):
-            self.model.to(self.dls.device)
+        device = getattr(self.dls, "device", None)
+        if device is not None:
+            self.model.to(device)
         if hasattr(self.model, "reset"):
             self.model.reset()
 
     def after_batch(self):
         "Update the iter counter (in training mode)"
-        self.learn.pct_train += 1.0 / (self.n_iter * self.n_epoch)
+        self.learn.pct_train += self._pct_inc
         self.learn.train_iter += 1
 
     def before_train(self):
         "Set the model in training mode"
         self.learn.pct_train = self.epoch / self.n_epoch
+        n_iter = len(self.dl)
+        self._pct_inc = 1.0 / (n_iter * self.n_epoch) if n_iter else 0.0
         self.model.train()
         self.learn.training = True
 
@@ -168,11 +202,79 @@ _ex_docs = dict(
 for c, d in _ex_docs.items():
     mk_class(c, sup=Exception, doc=d)
 
+# Cell
+def _n_samples(dl):
+    "Number of samples `dl` will go through, if it can be found"
+    for o in ("sampler", "dataset"):
+        try:
+            return len(getattr(dl, o))
+        except (AttributeError, TypeError):
+            pass
+
+
+# Cell
+class _Gather:
+    "Accumulate batches of tensors (or tuples of tensors) on the CPU, in buffers of `n` rows when possible"
+
+    def __init__(self, n=None):
+        self.n, self.bufs, self.off, self.items, self.stream = n, None, 0, [], None
+
+    def _fits(self, ts):
+        if not ts or self.n is None:
+            return False
+        if not all(isinstance(t, Tensor) and t.ndim > 0 for t in ts):
+            return False
+        bs = ts[0].shape[0]
+        if any(t.shape[0] != bs for t in ts) or self.off + bs > self.n:
+            return False
+        return self.bufs is None or (
+            len(ts) == len(self.bufs)
+            and all(
+                t.shape[1:] == b.shape[1:] and t.dtype == b.dtype
+                for t, b in zip(ts, self.bufs)
+            )
+        )
+
+    def _filled(self):
+        res = [b[: self.off] for b in self.bufs]
+        return res[0] if self.typ is None else self.typ(res)
+
+    def append(self, b):
+        "Add the batch `b`, copied asynchronously from the GPU when possible"
+        ts = tuple(b) if is_listy(b) else (b,)
+        if self.items or not self._fits(ts):
+            if self.bufs is not None:
+                self.items.append(self._filled())
+                self.bufs = None
+            self.items.append(to_detach(b, gather=False))
+            return
+        if self.bufs is None:
+            self.typ = type(b) if is_listy(b) else None
+            self.bufs = [
+                torch.empty((self.n, *t.shape[1:]), dtype=t.dtype, pin_memory=t.is_cuda)
+                for t in ts
+            ]
+        bs = ts[0].shape[0]
+        for buf, t in zip(self.bufs, ts):
+            if t.is_cuda:
+                self.stream = torch.cuda.current_stream(t.device)
+            buf[self.off : self.off + bs].copy_(t, non_blocking=True)
+        self.off += bs
+
+    def concat(self, dim=0):
+        "All the batches, concatenated on `dim`"
+        if self.stream is not None:
+            self.stream.synchronize()  # Wait for the copies from the GPU to land
+        if self.items:
+            return to_concat(self.items, dim=dim)
+        return [] if self.bufs is None else self._filled()
+
+
 # Cell
 # TODO: save_targs and save_preds only handle preds/targets that have one tensor, not tuples of tensors.
 class GatherPredsCallback(Callback):
     "`Callback` that saves the predictions and targets, optionally `with_loss`"
-    _stateattrs = ("preds", "targets", "inputs", "losses")
+    _stateattrs = ("preds", "targets", "inputs", "losses", "_detach")
 
     def __init__(
         self,
@@ -186,48 +288,54 @@ class GatherPredsCallback(Callback):
 
     def before_batch(self):
         if self.with_input:
-            self.inputs.append((self.learn.to_detach(self.xb)))
+            self.inputs.append((self._detach(self.xb, cpu=False)))
 
     def before_validate(self):
         "Initialize containers"
-        self.preds, self.targets = [], []
+        self._detach = self.learn.to_detach
+        # Batches are written straight into buffers sized for the whole `dl` when possible
+        n = _n_samples(self.learn.dl) if self.concat_dim == 0 else None
+        self.preds, self.targets = _Gather(n), _Gather(n)
         if self.with_input:
-            self.inputs = []
+            self.inputs = _Gather(n)
         if self.with_loss:
-            self.losses = []
+            self.losses = _Gather(n)
 
     def after_batch(self):
         "Save predictions, targets and potentially losses"
         if not hasattr(self, "pred"):
             return
-        preds, targs = self.learn.to_detach(self.pred), self.learn.to_detach(self.yb)
-        if self.save_preds is None:
+        # Tensors stay on their device here, `_Gather` moves them to the CPU without blocking
+        learn, detach = self.learn, self._detach
+        preds, targs = detach(learn.pred, cpu=False), detach(learn.yb, cpu=False)
+        save_preds, save_targs = self.save_preds, self.save_targs
+        if save_preds is None:
             self.preds.append(preds)
         else:
-            (self.save_preds / str(self.iter)).save_array(preds)
-        if self.save_targs is None:
+            (save_preds / str(learn.iter)).save_array(to_detach(preds, gather=False))
+        if save_targs is None:
             self.targets.append(targs)
         else:
-            (self.save_targs / str(self.iter)).save_array(targs[0])
+            (save_targs / str(learn.iter)).save_array(to_detach(targs[0], gather=False))
         if self.with_loss:
-            bs = find_bs(self.yb)
-            loss = (
-                self.loss if self.loss.numel() == bs else self.loss.view(bs, -1).mean(1)
-            )
-            self.losses.append(self.learn.to_detach(loss))
+            bs = find_bs(learn.yb)
+            loss = learn.loss
+            if loss.numel() != bs:
+                loss = loss.view(bs, -1).mean(1)
+            self.losses.append(detach(loss, cpu=False))
 
     def after_validate(self):
         "Concatenate all recorded tensors"
         if not hasattr(self, "preds"):
             return
         if self.with_input:
-            self.inputs = detuplify(to_concat(self.inputs, dim=self.concat_dim))
+            self.inputs = detuplify(self.inputs.concat(dim=self.concat_dim))
         if not self.save_preds:
-            self.preds = detuplify(to_concat(self.preds, dim=self.concat_dim))
+            self.preds = detuplify(self.preds.concat(dim=self.concat_dim))
         if not self.save_targs:
-            self.targets = detuplify(to_concat(self.targets, dim=self.concat_dim))
+            self.targets = detuplify(self.targets.concat(dim=self.concat_dim))
         if self.with_loss:
-            self.losses = to_concat(self.losses)
+            self.losses = self.losses.concat()
 
     def all_tensors(self):
         res = [
@@ -33,6 +33,7 @@ __all__ = [
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language
 
+import bisect
 import collections
 import functools
 import math
@@ -43,14 +44,14 @@ import numpy as np
 import torch
 
 # Cell
-from fastcore.basics import patch, store_attr
+from fastcore.basics import listify, patch, store_attr
 from fastcore.foundation import L
 from fastcore.meta import delegates
 from fastcore.xtras import is_listy
 
 from ..learner import Learner, Recorder
 from ..optimizer import convert_params
-from ..utils import defaults, params, tensor
+from ..utils import defaults, params
 from .core import Callback, CancelFitException, CancelValidException
 
 
@@ -112,9 +113,27 @@ def SchedLin(start, end):
     return _Annealer(sched_lin, start, end)
 
 
+# Cosine ramp from 0 to 1 sampled over [0, 1], linearly interpolated by `_CosAnnealer`
+_cos_tbl_sz = 4096
+_cos_tbl = (0.5 * (1 + np.cos(np.pi * (1 - np.linspace(0, 1, _cos_tbl_sz + 1))))).tolist()
+
+
+class _CosAnnealer(_Annealer):
+    def __init__(self, start, end):
+        super().__init__(sched_cos, start, end)
+
+    def __call__(self, pos):
+        if not 0 <= pos < 1:
+            return sched_cos(self.start, self.end, pos)
+        i = pos * _cos_tbl_sz
+        lo = int(i)
+        c = _cos_tbl[lo] + (i - lo) * (_cos_tbl[lo + 1] - _cos_tbl[lo])
+        return self.start + c * (self.end - self.start)
+
+
 def SchedCos(start, end):
     "Cosine schedule function from `start` to `end`"
-    return _Annealer(sched_cos, start, end)
+    return _CosAnnealer(start, end)
 
 
 def SchedNo(start, end):
@@ -138,20 +157,45 @@ def SchedPoly(start, end, power):
     return _inner
 
 
+# Cell
+def _sched_cos_np(start, end, pos):
+    return start + (1 + np.cos(np.pi * (1 - pos))) * (end - start) / 2
+
+
+_np_scheds = {
+    sched_lin: sched_lin,
+    sched_cos: _sched_cos_np,
+    sched_no: sched_no,
+    sched_exp: sched_exp,
+}
+
+
+def _tabulate(f, pos):
+    "Values of `f` at all the positions in `pos`, in one numpy op for the `Sched*` functions"
+    if is_listy(f):
+        return np.stack([_tabulate(f_, pos) for f_ in f], axis=1)
+    if isinstance(f, _Annealer) and f.f in _np_scheds:
+        # Positions on the first axis, (maybe per-group) `start`/`end` on the others
+        pos = pos.reshape(-1, *[1] * max(np.ndim(f.start), np.ndim(f.end)))
+        res = _np_scheds[f.f](f.start, f.end, pos)
+        return np.broadcast_to(res, np.broadcast(pos, f.start, f.end).shape)
+    return np.array([f(p) for p in pos])
+
+
 # Cell
 def combine_scheds(pcts, scheds):
     "Combine `scheds` according to `pcts` in one function"
-    assert sum(pcts) == 1.0
-    pcts = tensor([0] + L(pcts))
-    assert torch.all(pcts >= 0)
-    pcts = torch.cumsum(pcts, 0)
+    pcts = np.asarray(pcts, dtype=np.float64)
+    assert abs(pcts.sum() - 1.0) < 1e-7
+    assert (pcts >= 0).all()
+    # Plain floats, so finding the current schedule is a `bisect` without any tensor op
+    pcts = np.concatenate(([0.0], pcts)).cumsum().tolist()
 
     def _inner(pos):
-        if int(pos) == 1:
+        if pos >= 1.0:
             return scheds[-1](1.0)
-        idx = (pos >= pcts).nonzero().max()
-        actual_pos = (pos - pcts[idx]) / (pcts[idx + 1] - pcts[idx])
-        return scheds[idx](actual_pos.item())
+        idx = min(bisect.bisect_right(pcts, pos) - 1, len(scheds) - 1)
+        return scheds[idx]((pos - pcts[idx]) / (pcts[idx + 1] - pcts[idx]))
 
     return _inner
 
@@ -159,9 +203,19 @@ def combine_scheds(pcts, scheds):
 # Cell
 def combined_cos(pct, start, middle, end):
     "Return a scheduler with cosine annealing from `start`→`middle` & `middle`→`end`"
-    return combine_scheds(
-        [pct, 1 - pct], [SchedCos(start, middle), SchedCos(middle, end)]
-    )
+    # Same as `combine_scheds([pct, 1-pct], [SchedCos(start, middle), SchedCos(middle, end)])`,
+    # with the two segments inlined since it runs at every batch of `fit_one_cycle`
+    assert 0 <= pct <= 1
+    d1, d2 = (middle - start) / 2, (end - middle) / 2
+
+    def _inner(pos):
+        if pos >= 1.0:
+            return end
+        if pos < pct:
+            return start + (1 - math.cos(math.pi * pos / pct)) * d1
+        return middle + (1 - math.cos(math.pi * (pos - pct) / (1 - pct))) * d2
+
+    return _inner
 
 
 # Cell
@@ -174,7 +228,9 @@ class ParamScheduler(Callback):
 
     def before_fit(self):
         "Initialize container for hyper-parameters"
-        self.hps = {p: [] for p in self.scheds.keys()}
+        self._keys, self._n_hps = list(self.scheds.keys()), 0
+        n = len(self.dls.train) * self.n_epoch
+        self.hps = {p: np.empty(n) for p in self._keys}
 
     def before_batch(self):
         "Set the proper hyper-parameters in the optimizer"
@@ -186,11 +242,17 @@ class ParamScheduler(Callback):
 
     def after_batch(self):
         "Record hyper-parameters of this batch"
-        for p in self.scheds.keys():
-            self.hps[p].append(self.opt.hypers[-1][p])
+        i, hps, last = self._n_hps, self.hps, self.opt.hypers[-1]
+        for p in self._keys:
+            if i == len(hps[p]):
+                hps[p] = np.concatenate([hps[p], np.empty(max(i, 1))])
+            hps[p][i] = last[p]
+        self._n_hps = i + 1
 
     def after_fit(self):
         "Save the hyper-parameters in the recorder if there is one"
+        if hasattr(self, "hps"):
+            self.hps = {p: v[: self._n_hps].tolist() for p, v in self.hps.items()}
         if hasattr(self.learn, "recorder") and hasattr(self, "hps"):
             self.recorder.hps = self.hps
 
@@ -218,7 +280,9 @@ def fit_one_cycle(
         "lr": combined_cos(pct_start, lr_max / div, lr_max, lr_max / div_final),
         "mom": combined_cos(pct_start, *(self.moms if moms is None else moms)),
     }
-    self.fit(n_epoch, cbs=ParamScheduler(scheds) + L(cbs), reset_opt=reset_opt, wd=wd)
+    self.fit(
+        n_epoch, cbs=[ParamScheduler(scheds)] + listify(cbs), reset_opt=reset_opt, wd=wd
+    )
 
 
 # Cell
@@ -252,7 +316,9 @@ def fit_flat_cos(
     self.opt.set_hyper("lr", self.lr if lr is None else lr)
     lr = np.array([h["lr"] for h in self.opt.hypers])
     scheds = {"lr": combined_cos(pct_start, lr, lr, lr / div_final)}
-    self.fit(n_epoch, cbs=ParamScheduler(scheds) + L(cbs), reset_opt=reset_opt, wd=wd)
+    self.fit(
+        n_epoch, cbs=[ParamScheduler(scheds)] + listify(cbs), reset_opt=reset_opt, wd=wd
+    )
 
 
 # Cell
@@ -276,7 +342,9 @@ def fit_sgdr(
     pcts = [cycle_len * cycle_mult ** i / n_epoch for i in range(n_cycles)]
     scheds = [SchedCos(lr_max, 0) for _ in range(n_cycles)]
     scheds = {"lr": combine_scheds(pcts, scheds)}
-    self.fit(n_epoch, cbs=ParamScheduler(scheds) + L(cbs), reset_opt=reset_opt, wd=wd)
+    self.fit(
+        n_epoch, cbs=[ParamScheduler(scheds)] + listify(cbs), reset_opt=reset_opt, wd=wd
+    )
 
 
 # Cell
@@ -320,21 +388,30 @@ class LRFinder(ParamScheduler):
     def before_fit(self):
         "Initialize container for hyper-parameters and save the model"
         super().before_fit()
+        # Positions are always `train_iter / num_it`, so all values can be computed upfront
+        pos = np.arange(self.num_it + 1) / self.num_it
+        self._tables = {n: _tabulate(f, pos) for n, f in self.scheds.items()}
         self.learn.save("_tmp")
         self.best_loss = float("inf")
 
     def before_batch(self):
         "Record hyper-parameters of this batch and potentially stop training"
-        self._update_val(self.train_iter / self.num_it)
+        i, opt = self.learn.train_iter, self.learn.opt
+        if i > self.num_it:
+            return self._update_val(i / self.num_it)
+        for n, tbl in self._tables.items():
+            opt.set_hyper(n, tbl[i])
 
     def after_batch(self):
         "Set the proper hyper-parameters in the optimizer"
         super().after_batch()
-        if self.smooth_loss < self.best_loss:
-            self.best_loss = self.smooth_loss
-        if self.smooth_loss > 4 * self.best_loss and self.stop_div:
+        # One conversion to a Python float instead of a tensor op per comparison
+        smooth_loss = float(self.learn.smooth_loss)
+        if smooth_loss < self.best_loss:
+            self.best_loss = smooth_loss
+        if smooth_loss > 4 * self.best_loss and self.stop_div:
             raise CancelFitException()
-        if self.train_iter >= self.num_it:
+        if self.learn.train_iter >= self.num_it:
             raise CancelFitException()
 
     def before_validate(self):
@@ -385,12 +462,11 @@ def lr_find(
     if show_plot:
         self.recorder.plot_lr_find()
     if suggestions:
-        lrs, losses = tensor(self.recorder.lrs[num_it // 10 : -5]), tensor(
-            self.recorder.losses[num_it // 10 : -5]
-        )
+        lrs = np.array(self.recorder.lrs[num_it // 10 : -5], dtype=float)
+        losses = np.array([float(l) for l in self.recorder.losses[num_it // 10 : -5]])
         if len(losses) == 0:
             return
-        lr_min = lrs[losses.argmin()].item()
-        grads = (losses[1:] - losses[:-1]) / (lrs[1:].log() - lrs[:-1].log())
-        lr_steep = lrs[grads.argmin()].item()
+        lr_min = float(lrs[losses.argmin()])
+        grads = np.diff(losses) / np.diff(np.log(lrs))
+        lr_steep = float(lrs[grads.argmin()])
         return SuggestedLRs(lr_min / 10.0, lr_steep)
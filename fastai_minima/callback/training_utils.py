@@ -1,6 +1,12 @@
 # flake8: noqa
 
-__all__ = ["ProgressCallback", "CollectDataCallback", "CudaCallback"]
+__all__ = [
+    "ProgressCallback",
+    "CollectDataCallback",
+    "CudaCallback",
+    "ChannelsLast",
+    "MixedPrecision",
+]
 
 # Cell
 # Contains code used/modified by fastai_minima author from fastai
@@ -17,16 +23,26 @@ __all__ = ["ProgressCallback", "CollectDataCallback", "CudaCallback"]
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language
 
+import time
 from contextlib import contextmanager
 
+import torch
 from fastcore.basics import ifnone, patch
+from fastcore.meta import delegates
 from fastprogress.fastprogress import master_bar, progress_bar
 
 from ..learner import Learner
-from ..utils import default_device, defaults, noop, to_device
+from ..utils import (
+    _Prefetcher,
+    default_device,
+    defaults,
+    noop,
+    to_device,
+    to_float,
+)
 
 # Cell
-from .core import Callback
+from .core import Callback, CancelStepException
 
 
 # Cell
@@ -60,6 +76,7 @@ class ProgressCallback(Callback):
 
     def after_train(self):
         "Close the progress bar over the training dataloader"
+        self._update_comment()
         self.pbar.on_iter_end()
 
     def after_validate(self):
@@ -69,6 +86,13 @@ class ProgressCallback(Callback):
     def after_batch(self):
         "Update the current progress bar"
         self.pbar.update(self.iter + 1)
+        # Formatting the loss reads it from the device: only do it a few times per second
+        now = time.monotonic()
+        if now - self._last_comment >= 0.05:
+            self._last_comment = now
+            self._update_comment()
+
+    def _update_comment(self):
         if hasattr(self, "smooth_loss"):
             self.pbar.comment = f"{self.smooth_loss:.4f}"
 
@@ -77,6 +101,7 @@ class ProgressCallback(Callback):
             self.dl, parent=getattr(self, "mbar", None), leave=False
         )
         self.pbar.update(0)
+        self._last_comment = 0.0
 
     def after_fit(self):
         "Close the master bar"
@@ -127,13 +152,146 @@ class CollectDataCallback(Callback):
 
 # Cell
 class CudaCallback(Callback):
-    "Move data to CUDA device"
+    "Move data to CUDA device, copying the next batch ahead of time (from a background thread if `prefetch`)"
+    _device = None
 
-    def __init__(self, device=None):
+    def __init__(self, device=None, prefetch=False):
         self.device = ifnone(device, default_device())
+        self.prefetch = prefetch
+
+    def _wrap_dl(self):
+        if not isinstance(self.learn.dl, _Prefetcher):
+            n = 2 if self.prefetch else 1
+            self.learn.dl = _Prefetcher(self.dl, self.device, n=n, thread=self.prefetch)
+
+    def _unwrap_dl(self):
+        if isinstance(self.learn.dl, _Prefetcher):
+            self.learn.dl = self.learn.dl.dl
+
+    before_train, before_validate = _wrap_dl, _wrap_dl
+    after_train, after_validate = _unwrap_dl, _unwrap_dl
 
     def before_batch(self):
-        self.learn.xb, self.learn.yb = to_device(self.xb), to_device(self.yb)
+        # Nothing to do when the batch already is on the right device (e.g. from `_Prefetcher`)
+        ts = (*self.learn.xb, *self.learn.yb)
+        if all(isinstance(t, torch.Tensor) and t.device == self._device for t in ts):
+            return
+        self.learn.xb = to_device(self.xb, self.device)
+        self.learn.yb = to_device(self.yb, self.device)
 
     def before_fit(self):
         self.model.to(self.device)
+        self._device = torch.device(self.device)
+        if self._device.type == "cuda" and self._device.index is None:
+            self._device = torch.device("cuda", torch.cuda.current_device())
+
+
+# Cell
+class ChannelsLast(Callback):
+    "Train with the model and 4d inputs in `torch.channels_last` memory format"
+    order = 1  # After `CudaCallback`, so inputs are converted on the device
+
+    def before_fit(self):
+        self.learn.model.to(memory_format=torch.channels_last)
+
+    def before_batch(self):
+        self.learn.xb = tuple(
+            t.contiguous(memory_format=torch.channels_last)
+            if isinstance(t, torch.Tensor) and t.dim() == 4
+            else t
+            for t in self.xb
+        )
+
+
+# Cell
+@patch
+def to_channels_last(self: Learner):
+    "Set `Learner` and inputs to `channels_last` format"
+    self.add_cb(ChannelsLast())
+    return self
+
+
+# Cell
+class MixedPrecision(Callback):
+    "Mixed precision training using `torch.cuda.amp`, `kwargs` are passed to the `GradScaler`"
+    order = 10
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    _in_autocast = False
+
+    def _exit_autocast(self):
+        # Idempotent: the exit is reached from `after_loss`, or from a later event when a batch
+        # was cancelled or raised before the loss
+        if self._in_autocast:
+            self.autocast.__exit__(None, None, None)
+            self._in_autocast = False
+
+    def before_fit(self):
+        if self._in_autocast:
+            # Left over from a fit interrupted by an exception
+            self._exit_autocast()
+        self.autocast, self.scaler = (
+            torch.cuda.amp.autocast(),
+            torch.cuda.amp.GradScaler(**self.kwargs),
+        )
+
+    def before_batch(self):
+        self._exit_autocast()
+        self.autocast.__enter__()
+        self._in_autocast = True
+
+    def after_pred(self):
+        self.learn.pred = to_float(self.pred)
+
+    def after_loss(self):
+        self._exit_autocast()
+
+    def after_cancel_batch(self):
+        self._exit_autocast()
+
+    def after_batch(self):
+        self._exit_autocast()
+
+    def before_backward(self):
+        self.learn.loss_grad = self.scaler.scale(self.loss_grad)
+
+    def before_step(self):
+        # `GradScaler` unscales the gradients and only calls `self.step` if they are all finite
+        self.skipped = True
+        self.scaler.step(self)
+        if self.skipped:
+            raise CancelStepException()
+
+    def after_step(self):
+        self.scaler.update()
+
+    @property
+    def param_groups(self):
+        "Pretend to be an optimizer for `GradScaler`"
+        return getattr(self.opt, "opt", self.opt).param_groups
+
+    def step(self, *args, **kwargs):
+        "Fake optimizer step to detect whether this batch was skipped by `GradScaler`"
+        self.skipped = False
+
+    def after_fit(self):
+        self._exit_autocast()
+        self.autocast, self.scaler = None, None
+
+
+# Cell
+@patch
+@delegates(torch.cuda.amp.GradScaler)
+def to_fp16(self: Learner, **kwargs):
+    "Set `Learner` to mixed precision training with `torch.cuda.amp`"
+    self.add_cb(MixedPrecision(**kwargs))
+    return self
+
+
+# Cell
+@patch
+def to_fp32(self: Learner):
+    "Set `Learner` to full precision training"
+    return self.remove_cb(MixedPrecision)
@@ -34,6 +34,7 @@ __all__ = [
 # See the License for the specific language
 
 # Cell
+import bisect
 import pickle
 import time
 from builtins import NotImplementedError
@@ -43,7 +44,7 @@ from functools import partial
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
-from fastcore.basics import GetAttr, Self, add_props, detuplify, patch, store_attr
+from fastcore.basics import GetAttr, add_props, detuplify, patch, store_attr
 from fastcore.foundation import L
 from fastcore.meta import delegates
 from fastcore.xtras import ContextManagers, Path, join_path_file
@@ -58,11 +59,14 @@ from .callback.core import (
     CancelValidException,
     GatherPredsCallback,
     TrainEvalCallback,
+    _events,
     event,
 )
 from .optimizer import Adam
 from .utils import (
     NoneType,
+    _on_device,
+    _Prefetcher,
     defaults,
     distrib_barrier,
     find_bs,
@@ -73,6 +77,7 @@ from .utils import (
     rank_distrib,
     tensor,
     to_detach,
+    to_device,
     trainable_params,
 )
 
@@ -82,15 +87,21 @@ class DataLoaders(GetAttr):
     "Basic wrapper around several `DataLoader`s."
     _default = "train"
 
-    def __init__(self, *loaders, path="."):
+    def __init__(self, *loaders, path=".", device=None):
         self.loaders, self.path = list(loaders), Path(path)
+        # Only set when given, otherwise `device` is the one of `train` (if it has one)
+        if device is not None:
+            self.device = device
+            if torch.device(device).type == "cuda":
+                # Page-locked batches can be copied to the GPU asynchronously
+                self.loaders = [_pinned(dl) for dl in self.loaders]
 
     def __getitem__(self, i):
         return self.loaders[i]
 
     def new_empty(self):
         loaders = [dl.new(dl.dataset.new_empty()) for dl in self.loaders]
-        return type(self)(*loaders, path=self.path, device=self.device)
+        return type(self)(*loaders, path=self.path, device=self.__dict__.get("device"))
 
     def _set(i, self, v):
         self.loaders[i] = v
@@ -102,10 +113,67 @@ class DataLoaders(GetAttr):
         "Grab one batch of data from the `DataLoader` at `ds_idx` in `self.loaders`"
         return next(iter(self.loaders[ds_idx]))
 
+    def make_persistent(self):
+        "Rebuild the `DataLoader`s that use worker processes so they keep them alive between epochs"
+        self.loaders = [_persistent(dl) for dl in self.loaders]
+        return self
+
+
+# Cell
+def _new_dl(dl, **kwargs):
+    "A copy of the PyTorch `DataLoader` `dl`, with the arguments in `kwargs` replaced"
+    kwargs = dict(
+        dict(
+            num_workers=dl.num_workers,
+            collate_fn=dl.collate_fn,
+            pin_memory=dl.pin_memory,
+            timeout=dl.timeout,
+            worker_init_fn=dl.worker_init_fn,
+            multiprocessing_context=dl.multiprocessing_context,
+            generator=dl.generator,
+            prefetch_factor=dl.prefetch_factor,
+            persistent_workers=dl.persistent_workers,
+        ),
+        **kwargs,
+    )
+    if isinstance(dl.dataset, torch.utils.data.IterableDataset):
+        kwargs.update(batch_size=dl.batch_size, drop_last=dl.drop_last)
+    elif dl.batch_size is None and dl.batch_sampler is not None:
+        kwargs.update(batch_sampler=dl.batch_sampler)
+    else:
+        kwargs.update(
+            batch_size=dl.batch_size, sampler=dl.sampler, drop_last=dl.drop_last
+        )
+    return torch.utils.data.DataLoader(dl.dataset, **kwargs)
+
+
+def _persistent(dl):
+    "A copy of the PyTorch `DataLoader` `dl` with `persistent_workers=True` (or `dl` if that's not applicable)"
+    if (
+        type(dl) is not torch.utils.data.DataLoader
+        or dl.num_workers == 0
+        or dl.persistent_workers
+    ):
+        return dl
+    return _new_dl(dl, persistent_workers=True)
+
+
+def _pinned(dl):
+    "A copy of the PyTorch `DataLoader` `dl` with `pin_memory=True` (or `dl` if that's not applicable)"
+    if type(dl) is not torch.utils.data.DataLoader or dl.pin_memory:
+        return dl
+    return _new_dl(dl, pin_memory=True)
+
 
 # Cell
 defaults.lr = 1e-3
 
+# Cell
+# Only used by `validate`: any tensor created under `torch.inference_mode`, including model state
+# like lazily grown caches or buffers set in `forward`, can't be saved for backward afterwards.
+# The validation of `fit` (followed by more training) and `get_preds` keep `torch.no_grad`.
+_inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
 # Cell
 def replacing_yield(o, attr, val):
     "Context manager to temporarily replace an attribute"
@@ -116,6 +184,21 @@ def replacing_yield(o, attr, val):
         setattr(o, attr, old)
 
 
+class _Replacing:
+    "Same as `replacing_yield`, as a plain class so entering it doesn't create a generator"
+    __slots__ = ("o", "attr", "val", "old")
+
+    def __init__(self, o, attr, val):
+        self.o, self.attr, self.val = o, attr, val
+
+    def __enter__(self):
+        self.old = getattr(self.o, self.attr)
+        setattr(self.o, self.attr, self.val)
+
+    def __exit__(self, *args):
+        setattr(self.o, self.attr, self.old)
+
+
 # Cell
 def mk_metric(m):
     "Convert `m` to an `AvgMetric`, unless it's already a `Metric`"
@@ -125,7 +208,7 @@ def mk_metric(m):
 
 
 # Cell
-def save_model(file, model, opt, with_opt=True, pickle_protocol=2):
+def save_model(file, model, opt, with_opt=True, pickle_protocol=4):
     "Save `model` to `file` along with `opt` (if available, and if `with_opt`)"
     if rank_distrib():
         return  # don't save if child proc
@@ -164,12 +247,16 @@ def _try_concat(o):
     try:
         return torch.cat(o)
     except:
-        return sum([L(o_[i, :] for i in range_of(o_)) for o_ in o], L())
+        return L(row for o_ in o for row in o_.unbind(0))
 
 
 # Cell
 _before_epoch = [event.before_fit, event.before_epoch]
 _after_epoch = [event.after_epoch, event.after_fit]
+_loop_events = {
+    t: (f"before_{t}", f"after_cancel_{t}", f"after_{t}")
+    for t in ("fit", "epoch", "train", "validate", "batch", "step")
+}
 
 # Cell
 class _ConstantFunc:
@@ -221,7 +308,7 @@ _loop = [
 
 # Cell
 class Learner(GetAttr):
-    _default = "model"
+    _default, _event_cbs = "model", None
 
     def __init__(
         self,
@@ -287,6 +374,7 @@ class Learner(GetAttr):
         cb.learn = self
         setattr(self, cb.name, cb)
         self.cbs.append(cb)
+        self._event_cbs = None
         return self
 
     def remove_cb(self, cb):
@@ -299,6 +387,7 @@ class Learner(GetAttr):
                 delattr(self, cb.name)
             if cb in self.cbs:
                 self.cbs.remove(cb)
+            self._event_cbs = None
         return self
 
     @contextmanager
@@ -319,18 +408,35 @@ class Learner(GetAttr):
         finally:
             self.add_cbs(cbs)
 
+    def _resort(self):
+        "Rebuild the per-event lists of `Callback`s, sorted by `order`"
+        srt = sorted(self.cbs, key=lambda cb: cb.order)
+        # Every callback sees `after_fit` so a disabled one can reset its `run` flag
+        self._event_cbs = {
+            e: tuple(cb for cb in srt if e == "after_fit" or hasattr(cb, e))
+            for e in _events
+        }
+        return self._event_cbs
+
     def ordered_cbs(self, event):
         "List of `Callback`s, in order, for an `event` in the training loop"
-        return [cb for cb in self.cbs.sorted("order") if hasattr(cb, event)]
+        cbs = (self._event_cbs or self._resort()).get(event, ())
+        return [cb for cb in cbs if hasattr(cb, event)]
 
     def __call__(self, event_name):
         "Call `event_name` for all `Callback`s in `self.cbs`"
-        L(event_name).map(self._call_one)
+        if isinstance(event_name, str):
+            return self._call_one(event_name)
+        for e in event_name:
+            self._call_one(e)
 
     def _call_one(self, event_name):
-        if not hasattr(event, event_name):
+        if event_name == "before_fit":
+            self._event_cbs = None
+        cbs = (self._event_cbs or self._resort()).get(event_name)
+        if cbs is None:
             raise Exception(f"missing {event_name}")
-        for cb in self.cbs.sorted("order"):
+        for cb in cbs:
             cb(event_name)
 
     def _bn_bias_state(self, with_bias):
@@ -349,35 +455,53 @@ class Learner(GetAttr):
     def _split(self, b):
         i = getattr(self.dls, "n_inp", 1 if len(b) == 1 else len(b) - 1)
         self.xb, self.yb = b[:i], b[i:]
+        device = getattr(self.dls, "device", None)
+        # Batches from `_Prefetcher` already are on `device`
+        if device is not None and not _on_device((*self.xb, *self.yb), device):
+            self.xb, self.yb = to_device((self.xb, self.yb), device)
 
     def _with_events(self, f, event_type, ex, final=noop):
+        before, cancel, after = _loop_events[event_type]
+        # Callbacks can be added or removed by `f`, so the lists are looked up each time
         try:
-            self(f"before_{event_type}")
+            for cb in (self._event_cbs or self._resort())[before]:
+                cb(before)
             f()
         except ex:
-            self(f"after_cancel_{event_type}")
-        self(f"after_{event_type}")
+            for cb in (self._event_cbs or self._resort())[cancel]:
+                cb(cancel)
+        for cb in (self._event_cbs or self._resort())[after]:
+            cb(after)
         final()
 
     def all_batches(self):
         "Train or evaluate `self.model` on all the batches of `self.dl`"
         self.n_iter = len(self.dl)
-        for o in enumerate(self.dl):
-            self.one_batch(*o)
+        dl, device = self.dl, getattr(self.dls, "device", None)
+        # The next batch is copied while this one is used (unless `CudaCallback` already does it)
+        if (
+            device is not None
+            and torch.device(device).type == "cuda"
+            and not isinstance(dl, _Prefetcher)
+        ):
+            dl = _Prefetcher(dl, device)
+        one_batch = self.one_batch
+        for i, b in enumerate(dl):
+            one_batch(i, b)
 
     def _do_one_batch(self):
         self.pred = self.model(*self.xb)
         self("after_pred")
         if len(self.yb):
             self.loss_grad = self.loss_func(self.pred, *self.yb)
-            self.loss = self.loss_grad.clone()
+            self.loss = self.loss_grad.detach()
         self("after_loss")
         if not self.training or not len(self.yb):
             return
         self("before_backward")
         self.loss_grad.backward()
         self._with_events(self.opt.step, "step", CancelStepException)
-        self.opt.zero_grad()
+        self.opt.zero_grad(set_to_none=True)
 
     def one_batch(self, i, b):
         "Train or evaluate `self.model` on batch `(xb,yb)`"
@@ -416,6 +540,8 @@ class Learner(GetAttr):
                 self.opt.set_hypers(wd=wd)
             self.opt.set_hypers(lr=self.lr if lr is None else lr)
             self.n_epoch = n_epoch
+            # Picks up changes the cache can't see: `cbs` edited directly, `order` or events changed
+            self._event_cbs = None
             self._with_events(
                 self._do_fit, "fit", CancelFitException, self._end_cleanup
             )
@@ -449,7 +575,7 @@ class Learner(GetAttr):
         "Validate on `dl` with potential new `cbs`."
         if dl is None:
             dl = self.dls[ds_idx]
-        with self.validation_context(cbs=cbs):
+        with self.validation_context(cbs=cbs), _inference_mode():
             self._do_epoch_validate(ds_idx, dl)
         return getattr(self, "final_record", None)
 
@@ -481,23 +607,22 @@ class Learner(GetAttr):
             raise NotImplementedError(
                 "You're trying to use non-basic fastai functionality. You should use the entire fastai API to get this feature"
             )
+        # Looked up before `loss_not_reduced` can swap `loss_func` for a `partial`
+        if act is None:
+            act = getattr(self.loss_func, "activation", noop)
+        decodes = getattr(self.loss_func, "decodes", noop)
         cb = GatherPredsCallback(with_input=with_input, with_loss=with_loss, **kwargs)
         ctx_mgrs = self.validation_context(cbs=L(cbs) + [cb], inner=inner)
         if with_loss:
             ctx_mgrs.append(self.loss_not_reduced())
         with ContextManagers(ctx_mgrs):
             self._do_epoch_validate(dl=dl)
-            if act is None:
-                act = getattr(self.loss_func, "activation", noop)
             res = cb.all_tensors()
             pred_i = 1 if with_input else 0
             if res[pred_i] is not None:
                 res[pred_i] = act(res[pred_i])
                 if with_decoded:
-                    res.insert(
-                        pred_i + 2,
-                        getattr(self.loss_func, "decodes", noop)(res[pred_i]),
-                    )
+                    res.insert(pred_i + 2, decodes(res[pred_i]))
             if reorder and hasattr(dl, "get_idxs"):
                 res = nested_reorder(res, tensor(idxs).argsort())
             return tuple(res)
@@ -528,23 +653,20 @@ class Learner(GetAttr):
             else:
                 print(f'{" "*indent} - {s:15}:', self.ordered_cbs(s))
 
-    @contextmanager
     def no_logging(self):
         "Context manager to temporarily remove `logger`"
-        return replacing_yield(self, "logger", noop)
+        return _Replacing(self, "logger", noop)
 
-    @contextmanager
     def no_mbar(self):
         "Context manager to temporarily prevent the master progress bar from being created"
-        return replacing_yield(self, "create_mbar", False)
+        return _Replacing(self, "create_mbar", False)
 
-    @contextmanager
     def loss_not_reduced(self):
         "A context manager to evaluate `loss_func` with reduction set to none."
         if hasattr(self.loss_func, "reduction"):
-            return replacing_yield(self.loss_func, "reduction", "none")
+            return _Replacing(self.loss_func, "reduction", "none")
         else:
-            return replacing_yield(
+            return _Replacing(
                 self, "loss_func", partial(self.loss_func, reduction="none")
             )
 
@@ -590,8 +712,8 @@ def save(self: Learner, file, **kwargs):
 @delegates(load_model)
 def load(self: Learner, file, device=None, **kwargs):
     "Load model and optimizer state (if `with_opt`) from `self.path/self.model_dir/file` using `device`"
-    if device is None and hasattr(self.dls, "device"):
-        device = self.dls.device
+    if device is None:
+        device = getattr(self.dls, "device", None)
     if self.opt is None:
         self.create_opt()
     file = join_path_file(file, self.path / self.model_dir, ext=".pth")
@@ -673,13 +795,24 @@ class Metric:
 
 # Cell
 def _maybe_reduce(val):
-    if num_distrib() > 1:
+    n = num_distrib()
+    if n > 1:
         val = val.clone()
         torch.distributed.all_reduce(val, op=torch.distributed.ReduceOp.SUM)
-        val /= num_distrib()
+        val /= n
     return val
 
 
+def _reduced_avg(total, count):
+    "`total/count` on the CPU, with `total` and `count` summed across processes (if training is distributed)"
+    if num_distrib() > 1 and isinstance(total, torch.Tensor):
+        # One collective for both numbers, once per epoch instead of once per batch
+        val = torch.stack([total.float(), total.new_tensor(count, dtype=torch.float)])
+        torch.distributed.all_reduce(val, op=torch.distributed.ReduceOp.SUM)
+        total, count = val[0], val[1]
+    return to_detach(total / count, gather=False)
+
+
 # Cell
 class AvgMetric(Metric):
     "Average the values of `func` taking into account potential different batch sizes"
@@ -692,12 +825,14 @@ class AvgMetric(Metric):
 
     def accumulate(self, learn):
         bs = find_bs(learn.yb)
-        self.total += learn.to_detach(self.func(learn.pred, *learn.yb)) * bs
+        # Keep the running total on the model's device, it's only synced in `value`
+        v = learn.to_detach(self.func(learn.pred, *learn.yb), cpu=False, gather=False)
+        self.total += v * bs
         self.count += bs
 
     @property
     def value(self):
-        return self.total / self.count if self.count != 0 else None
+        return _reduced_avg(self.total, self.count) if self.count != 0 else None
 
     @property
     def name(self):
@@ -717,12 +852,12 @@ class AvgLoss(Metric):
 
     def accumulate(self, learn):
         bs = find_bs(learn.yb)
-        self.total += learn.to_detach(learn.loss.mean()) * bs
+        self.total += learn.to_detach(learn.loss.mean(), cpu=False, gather=False) * bs
         self.count += bs
 
     @property
     def value(self):
-        return self.total / self.count if self.count != 0 else None
+        return _reduced_avg(self.total, self.count) if self.count != 0 else None
 
     @property
     def name(self):
@@ -741,9 +876,9 @@ class AvgSmoothLoss(Metric):
 
     def accumulate(self, learn):
         self.count += 1
-        self.val = torch.lerp(
-            to_detach(learn.loss.mean(), gather=False), self.val, self.beta
-        )
+        # Stays on the loss' device, `Recorder` moves the recorded values to the CPU once per epoch
+        loss = learn.loss.mean().detach()
+        self.val = torch.lerp(loss, self.val.to(loss.device), self.beta)
 
     @property
     def value(self):
@@ -783,7 +918,7 @@ def _maybe_item(t):
 class Recorder(Callback):
     "Callback that registers statistics (lr, loss and metrics) during training"
     _stateattrs = ("lrs", "iters", "losses", "values")
-    remove_on_fetch, order = True, 50
+    remove_on_fetch, order, _batch_mets = True, 50, None
 
     def __init__(
         self, add_time=True, train_metrics=False, valid_metrics=True, beta=0.98
@@ -794,6 +929,7 @@ class Recorder(Callback):
     def before_fit(self):
         "Prepare state for training"
         self.lrs, self.iters, self.losses, self.values = [], [], [], []
+        self._n_synced = 0
         names = self.metrics.attrgot("name")
         if self.train_metrics and self.valid_metrics:
             names = L("loss") + names
@@ -809,16 +945,20 @@ class Recorder(Callback):
 
     def after_batch(self):
         "Update all metrics and records lr and smooth loss in training"
-        if len(self.yb) == 0:
+        # Read the learner's state directly rather than through `Callback.__getattr__`
+        learn = self.learn
+        if len(learn.yb) == 0:
             return
-        mets = self._train_mets if self.training else self._valid_mets
+        mets = self._batch_mets
+        if mets is None:
+            mets = self._train_mets if learn.training else self._valid_mets
         for met in mets:
-            met.accumulate(self.learn)
-        if not self.training:
+            met.accumulate(learn)
+        if not learn.training:
             return
-        self.lrs.append(self.opt.hypers[-1]["lr"])
-        self.losses.append(self.smooth_loss.value)
-        self.learn.smooth_loss = self.smooth_loss.value
+        self.lrs.append(learn.opt.hypers[-1]["lr"])
+        learn.smooth_loss = self.smooth_loss.value
+        self.losses.append(learn.smooth_loss)
 
     def before_epoch(self):
         "Set timer if `self.add_time=True`"
@@ -829,18 +969,24 @@ class Recorder(Callback):
 
     def before_train(self):
         "Reset loss and metrics state"
-        self._train_mets[1:].map(Self.reset())
+        self._batch_mets = tuple(self._train_mets)
+        for met in self._batch_mets[1:]:
+            met.reset()
 
     def before_validate(self):
         "Reset loss and metrics state"
-        self._valid_mets.map(Self.reset())
+        self._batch_mets = tuple(self._valid_mets)
+        for met in self._batch_mets:
+            met.reset()
 
     def after_train(self):
         "Log loss and metric values on the training set (if `self.training_metrics=True`)"
+        self._batch_mets = None
         self.log += self._train_mets.map(_maybe_item)
 
     def after_validate(self):
         "Log loss and metric values on the validation set"
+        self._batch_mets = None
         self.log += self._valid_mets.map(_maybe_item)
 
     def after_cancel_train(self):
@@ -859,6 +1005,19 @@ class Recorder(Callback):
             self.log.append(format_time(time.time() - self.start_epoch))
         self.logger(self.log)
         self.iters.append(self.smooth_loss.count)
+        self._sync_losses()
+
+    def after_fit(self):
+        "Move the smoothed losses of an interrupted epoch to the CPU"
+        self._sync_losses()
+
+    def _sync_losses(self):
+        if not hasattr(self, "_n_synced"):
+            return  # `before_fit` was cancelled before reaching us
+        new = self.losses[self._n_synced :]
+        if new:
+            self.losses[self._n_synced :] = list(torch.stack(new).cpu())
+        self._n_synced = len(self.losses)
 
     @property
     def _train_mets(self):
@@ -880,7 +1039,7 @@ class Recorder(Callback):
             label="train",
         )
         if with_valid:
-            idx = (np.array(self.iters) < skip_start).sum()
+            idx = bisect.bisect_left(self.iters, skip_start)
             plt.plot(self.iters[idx:], L(self.values[idx:]).itemgot(1), label="valid")
             plt.legend()
 
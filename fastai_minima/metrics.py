@@ -67,11 +67,12 @@ __all__ = [
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language
 
-from collections import Counter
-from functools import partial
+import math
+from functools import partial, wraps
 
 import numpy as np
 import scipy.stats as scs
+from numpy.lib.stride_tricks import sliding_window_view
 
 # Cell
 import sklearn.metrics as skm
@@ -81,15 +82,35 @@ from fastcore.basics import mk_class, store_attr
 from fastcore.meta import delegates
 
 from .learner import AvgLoss, AvgMetric, Learner, Metric
-from .utils import to_detach
+from .utils import find_bs, to_detach
+
+
+# Cell
+def _lazy_script(f):
+    "`f` compiled with `torch.jit.script` at its first call (instead of at import), or `f` itself if that fails"
+    scripted = None
+
+    @wraps(f)
+    def _inner(*args):
+        nonlocal scripted
+        if scripted is None:
+            try:
+                scripted = torch.jit.script(f)
+            except Exception:
+                scripted = f
+        return scripted(*args)
+
+    return _inner
 
 
 # Cell
 def flatten_check(inp, targ):
     "Check that `out` and `targ` have the same number of elements and flatten them."
-    inp, targ = inp.contiguous().view(-1), targ.contiguous().view(-1)
-    test_eq(len(inp), len(targ))
-    return inp, targ
+    if inp.numel() != targ.numel():
+        raise ValueError(
+            f"Predictions of shape {tuple(inp.shape)} and targets of shape {tuple(targ.shape)} don't have the same number of elements"
+        )
+    return inp.reshape(-1), targ.reshape(-1)
 
 
 # Cell
@@ -99,9 +120,94 @@ mk_class(
     doc="All possible activation classes for `AccumMetric",
 )
 
+# Cell
+class _Rows:
+    "Batches of rows copied in one buffer (on `device` if given) growing geometrically, kept as a list of tensors if their shapes or dtypes differ"
+
+    def __init__(self, device=None):
+        self.buf, self.n, self.items, self.n_batches = None, 0, [], 0
+        self.device = None if device is None else torch.device(device)
+        self.pending = False
+
+    def __len__(self):
+        return self.n_batches
+
+    def _fits(self, t):
+        b = self.buf
+        return (
+            t.shape[1:] == b.shape[1:]
+            and t.dtype == b.dtype
+            and (self.device is not None or t.device == b.device)
+        )
+
+    def _new_buf(self, t, sz):
+        if self.device is None:
+            return t.new_empty((sz, *t.shape[1:]))
+        # Pinned on the CPU so the copies from the GPU are asynchronous
+        pin = self.device.type == "cpu" and t.is_cuda
+        return torch.empty(
+            (sz, *t.shape[1:]), dtype=t.dtype, device=self.device, pin_memory=pin
+        )
+
+    def sync(self):
+        "Wait for the asynchronous copies from the GPU to be done"
+        if self.pending:
+            torch.cuda.synchronize()
+            self.pending = False
+
+    def append(self, t):
+        self.n_batches += 1
+        if self.buf is not None and (t.ndim == 0 or not self._fits(t)):
+            self.items.append(self.buf[: self.n])
+            self.buf = None
+        if self.items or t.ndim == 0:
+            self.items.append(t if self.device is None else t.to(self.device))
+            return
+        bs = t.shape[0]
+        if self.buf is None:
+            self.buf = self._new_buf(t, 2 * bs)
+        elif self.n + bs > len(self.buf):
+            buf = self._new_buf(t, max(2 * len(self.buf), self.n + bs))
+            self.sync()
+            buf[: self.n] = self.buf[: self.n]
+            self.buf = buf
+        self.buf[self.n : self.n + bs].copy_(t, non_blocking=True)
+        self.pending |= t.is_cuda and self.buf.device.type == "cpu"
+        self.n += bs
+
+    def cat(self):
+        self.sync()
+        return torch.cat(self.items) if self.items else self.buf[: self.n]
+
+    def numpy(self):
+        self.sync()
+        if self.items and all(t.device.type == "cpu" for t in self.items):
+            # Quicker than `torch.cat` on many small tensors, and `.numpy()` is free on the CPU
+            return np.concatenate([t.numpy() for t in self.items])
+        return self.cat().cpu().numpy()
+
+
+def _cat(o, to_np=False, cpu=True):
+    "Concatenate the accumulated batches in `o` on the CPU (if `cpu`), as a numpy array if `to_np`"
+    if to_np and isinstance(o, _Rows):
+        return o.numpy()
+    if isinstance(o, torch.Tensor):
+        # A single tensor assigned to `preds`/`targs`, `torch.cat` would iterate over its first dim
+        o = [o]
+    res = o.cat() if isinstance(o, _Rows) else torch.cat(o)
+    if cpu or to_np:
+        res = res.cpu()
+    return res.numpy() if to_np else res
+
+
+def _as_float(o, dtype):
+    "Cast the float array `o` to `dtype`, without a copy if it already has it"
+    return o.astype(dtype, copy=False) if np.issubdtype(o.dtype, np.floating) else o
+
+
 # Cell
 class AccumMetric(Metric):
-    "Stores predictions and targets on CPU in accumulate to perform final calculations with `func`."
+    "Stores predictions and targets in accumulate (on `device`, the CPU by default) to perform final calculations with `func`."
 
     def __init__(
         self,
@@ -112,18 +218,33 @@ class AccumMetric(Metric):
         to_np=False,
         invert_arg=False,
         flatten=True,
+        device="cpu",
+        defer_activation=False,
+        dtype=None,
         **kwargs,
     ):
-        store_attr("func,dim_argmax,activation,thresh,flatten")
+        store_attr("func,dim_argmax,activation,thresh,flatten,device,dtype")
         self.to_np, self.invert_args, self.kwargs = to_np, invert_arg, kwargs
+        # Only worth it with an activation or a threshold: argmax indices are smaller than the raw preds
+        self.defer_activation = defer_activation and (
+            self.activation != ActivationType.No or bool(self.thresh)
+        )
 
     def reset(self):
         "Clear all targs and preds"
-        self.targs, self.preds = [], []
+        self.targs, self.preds = _Rows(self.device), _Rows(self.device)
+        self._raw = False
 
     def accumulate(self, learn: Learner):
         "Store targs and preds from `learn`, using activation function and argmax as appropriate"
-        pred = learn.pred
+        if self.defer_activation:
+            # Raw preds are stored and `_activate` runs once on all of them in `value`
+            self._raw = True
+            return self.accum_values(learn.pred, learn.y, learn)
+        self.accum_values(self._activate(learn.pred), learn.y, learn)
+
+    def _activate(self, pred):
+        "Apply the activation function, argmax and threshold to `pred`"
         if self.activation in [ActivationType.Softmax, ActivationType.BinarySoftmax]:
             pred = F.softmax(pred, dim=self.dim_argmax)
             if self.activation == ActivationType.BinarySoftmax:
@@ -134,13 +255,15 @@ class AccumMetric(Metric):
             pred = pred.argmax(dim=self.dim_argmax)
         if self.thresh:
             pred = pred >= self.thresh
-        self.accum_values(pred, learn.y, learn)
+        return pred
 
     def accum_values(self, preds, targs, learn=None):
         "Store targs and preds"
+        # Copied to the CPU through pinned memory without blocking by default. `device=None` keeps
+        # them on the GPU until `value`: fewer transfers, but the whole epoch is held in GPU memory.
         to_d = learn.to_detach if learn is not None else to_detach
-        preds, targs = to_d(preds), to_d(targs)
-        if self.flatten:
+        preds, targs = to_d(preds, cpu=False), to_d(targs, cpu=False)
+        if self.flatten and not self._raw:
             preds, targs = flatten_check(preds, targs)
         self.preds.append(preds)
         self.targs.append(targs)
@@ -156,9 +279,18 @@ class AccumMetric(Metric):
         "Value of the metric using accumulated preds and targs"
         if len(self.preds) == 0:
             return
-        preds, targs = torch.cat(self.preds), torch.cat(self.targs)
-        if self.to_np:
-            preds, targs = preds.numpy(), targs.numpy()
+        if self._raw:
+            preds = self._activate(_cat(self.preds, cpu=False))
+            targs = _cat(self.targs, cpu=False)
+            if self.flatten:
+                preds, targs = flatten_check(preds, targs)
+            preds, targs = preds.cpu(), targs.cpu()
+            if self.to_np:
+                preds, targs = preds.numpy(), targs.numpy()
+        else:
+            preds, targs = _cat(self.preds, self.to_np), _cat(self.targs, self.to_np)
+        if self.to_np and self.dtype is not None:
+            preds, targs = _as_float(preds, self.dtype), _as_float(targs, self.dtype)
         return (
             self.func(targs, preds, **self.kwargs)
             if self.invert_args
@@ -216,10 +348,14 @@ def optim_metric(f, argname, bounds, tol=0.01, do_neg=True, get_x=False):
 
 
 # Cell
+@_lazy_script
+def _accuracy(pred, targ):
+    return (pred == targ).float().mean()
+
+
 def accuracy(inp, targ, axis=-1):
     "Compute accuracy with `targ` when `pred` is bs * n_classes"
-    pred, targ = flatten_check(inp.argmax(dim=axis), targ)
-    return (pred == targ).float().mean()
+    return _accuracy(*flatten_check(inp.argmax(dim=axis), targ))
 
 
 # Cell
@@ -232,8 +368,8 @@ def error_rate(inp, targ, axis=-1):
 def top_k_accuracy(inp, targ, k=5, axis=-1):
     "Computes the Top-k accuracy (`targ` is in the top `k` predictions of `inp`)"
     inp = inp.topk(k=k, dim=axis)[1]
-    targ = targ.unsqueeze(dim=axis).expand_as(inp)
-    return (inp == targ).sum(dim=-1).float().mean()
+    # The top `k` indices are distinct, so at most one of them matches `targ`
+    return (inp == targ.unsqueeze(dim=axis)).any(dim=-1).float().mean()
 
 
 # Cell
@@ -357,12 +493,71 @@ def Recall(axis=-1, labels=None, pos_label=1, average="binary", sample_weight=No
     )
 
 
+# Cell
+class _BucketedRocAuc(Metric):
+    "Macro one-vs-rest ROC AUC from per-class histograms of the probabilities in `n_buckets`, in constant memory"
+
+    def __init__(self, n_buckets, axis=-1, binary=False):
+        store_attr("n_buckets,axis,binary")
+
+    def reset(self):
+        self.pos, self.neg = 0, 0
+
+    def accumulate(self, learn):
+        pred = F.softmax(learn.pred.detach(), dim=self.axis)
+        pred = pred.transpose(self.axis, -1).reshape(-1, pred.shape[self.axis])
+        n_cls, targ = pred.shape[1], learn.y.reshape(-1)
+        if self.binary:
+            pred, is_pos = pred[:, -1:], (targ == n_cls - 1)[:, None]
+        else:
+            is_pos = F.one_hot(targ.long(), n_cls).bool()
+        bucket = (pred * self.n_buckets).long().clamp_(max=self.n_buckets - 1)
+        # One bincount for all classes, the buckets of class `c` are at `c * n_buckets`
+        idx = bucket + torch.arange(pred.shape[1], device=pred.device) * self.n_buckets
+        sz = idx.shape[1] * self.n_buckets
+        self.pos += torch.bincount(idx[is_pos], minlength=sz)
+        self.neg += torch.bincount(idx[~is_pos], minlength=sz)
+
+    @property
+    def value(self):
+        if not isinstance(self.pos, torch.Tensor):
+            return None
+        pos = self.pos.view(-1, self.n_buckets).cpu().double().numpy()
+        neg = self.neg.view(-1, self.n_buckets).cpu().double().numpy()
+        # Positives scored above each negative, the ones in the same bucket count half
+        pos_above = np.cumsum(pos[:, ::-1], axis=1)[:, ::-1] - pos
+        with np.errstate(divide="ignore", invalid="ignore"):
+            aucs = (neg * (pos_above + pos / 2)).sum(1) / (pos.sum(1) * neg.sum(1))
+        return aucs.mean()
+
+    @property
+    def name(self):
+        return "roc_auc_score"
+
+
+def _check_bucketed(average, sample_weight, max_fpr, multi_class):
+    assert (
+        average == "macro"
+        and sample_weight is None
+        and max_fpr is None
+        and multi_class in ["ovr", "raise"]
+    ), "`n_buckets` only supports the macro one-vs-rest AUC without `sample_weight` or `max_fpr`"
+
+
 # Cell
 def RocAuc(
-    axis=-1, average="macro", sample_weight=None, max_fpr=None, multi_class="ovr"
+    axis=-1,
+    average="macro",
+    sample_weight=None,
+    max_fpr=None,
+    multi_class="ovr",
+    n_buckets=None,
 ):
     "Area Under the Receiver Operating Characteristic Curve for single-label multiclass classification problems"
     assert multi_class in ["ovr", "ovo"]
+    if n_buckets is not None:
+        _check_bucketed(average, sample_weight, max_fpr, multi_class)
+        return _BucketedRocAuc(n_buckets, axis=axis)
     return skm_to_fastai(
         skm.roc_auc_score,
         axis=axis,
@@ -377,9 +572,17 @@ def RocAuc(
 
 # Cell
 def RocAucBinary(
-    axis=-1, average="macro", sample_weight=None, max_fpr=None, multi_class="raise"
+    axis=-1,
+    average="macro",
+    sample_weight=None,
+    max_fpr=None,
+    multi_class="raise",
+    n_buckets=None,
 ):
     "Area Under the Receiver Operating Characteristic Curve for single-label binary classification problems"
+    if n_buckets is not None:
+        _check_bucketed(average, sample_weight, max_fpr, multi_class)
+        return _BucketedRocAuc(n_buckets, axis=axis, binary=True)
     return skm_to_fastai(
         skm.roc_auc_score,
         axis=axis,
@@ -403,7 +606,8 @@ class Perplexity(AvgLoss):
 
     @property
     def value(self):
-        return torch.exp(self.total / self.count) if self.count != 0 else None
+        v = super().value
+        return torch.exp(v) if v is not None else None
 
     @property
     def name(self):
@@ -413,14 +617,22 @@ class Perplexity(AvgLoss):
 perplexity = Perplexity()
 
 # Cell
-def accuracy_multi(inp, targ, thresh=0.5, sigmoid=True):
-    "Compute accuracy when `inp` and `targ` are the same size."
-    inp, targ = flatten_check(inp, targ)
+@_lazy_script
+def _accuracy_multi(inp, targ, thresh: float, sigmoid: bool):
     if sigmoid:
         inp = inp.sigmoid()
     return ((inp > thresh) == targ.bool()).float().mean()
 
 
+def accuracy_multi(inp, targ, thresh=0.5, sigmoid=True):
+    "Compute accuracy when `inp` and `targ` are the same size."
+    inp, targ = flatten_check(inp, targ)
+    if sigmoid and 0 < thresh < 1:
+        # `sigmoid` is increasing: comparing the logits to the logit of `thresh` skips it
+        thresh, sigmoid = math.log(thresh / (1 - thresh)), False
+    return _accuracy_multi(inp, targ, float(thresh), sigmoid)
+
+
 # Cell
 def APScoreMulti(sigmoid=True, average="macro", pos_label=1, sample_weight=None):
     "Average Precision for multi-label classification problems"
@@ -613,31 +825,49 @@ def mse(inp, targ):
 
 
 # Cell
-def _rmse(inp, targ):
+# The elementwise metrics below are scripted so the fuser can run them in a single kernel on the GPU
+@_lazy_script
+def _rmse_fused(inp, targ):
     return torch.sqrt(F.mse_loss(inp, targ))
 
 
+def _rmse(inp, targ):
+    return _rmse_fused(inp, targ)
+
+
 rmse = AccumMetric(_rmse)
 rmse.__doc__ = "Root mean squared error"
 
 # Cell
+@_lazy_script
+def _mae(inp, targ):
+    return torch.abs(inp - targ).mean()
+
+
 def mae(inp, targ):
     "Mean absolute error between `inp` and `targ`."
-    inp, targ = flatten_check(inp, targ)
-    return torch.abs(inp - targ).mean()
+    return _mae(*flatten_check(inp, targ))
 
 
 # Cell
+@_lazy_script
+def _msle(inp, targ):
+    return F.mse_loss(torch.log(1 + inp), torch.log(1 + targ))
+
+
 def msle(inp, targ):
     "Mean squared logarithmic error between `inp` and `targ`."
-    inp, targ = flatten_check(inp, targ)
-    return F.mse_loss(torch.log(1 + inp), torch.log(1 + targ))
+    return _msle(*flatten_check(inp, targ))
 
 
 # Cell
+@_lazy_script
+def _exp_rmspe_fused(inp, targ):
+    return torch.sqrt((1 - torch.exp(inp - targ)).pow(2).mean())
+
+
 def _exp_rmspe(inp, targ):
-    inp, targ = torch.exp(inp), torch.exp(targ)
-    return torch.sqrt(((targ - inp) / targ).pow(2).mean())
+    return _exp_rmspe_fused(inp, targ)
 
 
 exp_rmspe = AccumMetric(_exp_rmspe)
@@ -705,13 +935,21 @@ class Dice(Metric):
         self.inter, self.union = 0, 0
 
     def accumulate(self, learn):
-        pred, targ = flatten_check(learn.pred.argmax(dim=self.axis), learn.y)
-        self.inter += (pred * targ).float().sum().item()
-        self.union += (pred + targ).float().sum().item()
+        pred = learn.pred
+        if pred.shape[self.axis] == 2:
+            # Same as the argmax for two classes (ties go to 0), with one compare
+            pred = (pred.select(self.axis, 1) > pred.select(self.axis, 0)).long()
+        else:
+            pred = pred.argmax(dim=self.axis)
+        pred, targ = flatten_check(pred, learn.y)
+        # Summed on the device, only synced in `value`
+        self.inter += (pred * targ).float().sum()
+        self.union += (pred + targ).float().sum()
 
     @property
     def value(self):
-        return 2.0 * self.inter / self.union if self.union > 0 else None
+        inter, union = float(self.inter), float(self.union)
+        return 2.0 * inter / union if union > 0 else None
 
 
 # Cell
@@ -722,30 +960,31 @@ class DiceMulti(Metric):
         self.axis = axis
 
     def reset(self):
-        self.inter, self.union = {}, {}
+        self.inter, self.union = 0, 0
 
     def accumulate(self, learn):
-        pred, targ = flatten_check(learn.pred.argmax(dim=self.axis), learn.y)
-        for c in range(learn.pred.shape[self.axis]):
-            p = torch.where(pred == c, 1, 0)
-            t = torch.where(targ == c, 1, 0)
-            c_inter = (p * t).float().sum().item()
-            c_union = (p + t).float().sum().item()
-            if c in self.inter:
-                self.inter[c] += c_inter
-                self.union[c] += c_union
-            else:
-                self.inter[c] = c_inter
-                self.union[c] = c_union
+        n = learn.pred.shape[self.axis]
+        pred = learn.pred.argmax(dim=self.axis)
+        if n <= torch.iinfo(torch.int16).max:
+            # Fewer bytes to read in the compare and bincounts below
+            pred = pred.to(torch.int16)
+        pred, targ = flatten_check(pred, learn.y)
+        # `torch.bincount` needs integers, masks can be loaded as floats (no-op if already long)
+        targ = targ.long()
+        # Per-class counts for all classes at once, kept on the device until `value`
+        self.inter += torch.bincount(pred[pred == targ], minlength=n)
+        targ = targ[(targ >= 0) & (targ < n)]
+        self.union += torch.bincount(pred, minlength=n) + torch.bincount(
+            targ, minlength=n
+        )
 
     @property
     def value(self):
-        binary_dice_scores = np.array([])
-        for c in self.inter:
-            binary_dice_scores = np.append(
-                binary_dice_scores,
-                2.0 * self.inter[c] / self.union[c] if self.union[c] > 0 else np.nan,
-            )
+        if not isinstance(self.inter, torch.Tensor):
+            return np.nan
+        inter, union = self.inter.cpu().numpy(), self.union.cpu().numpy()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            binary_dice_scores = np.where(union > 0, 2.0 * inter / union, np.nan)
         return np.nanmean(binary_dice_scores)
 
 
@@ -755,15 +994,122 @@ class JaccardCoeff(Dice):
 
     @property
     def value(self):
-        return self.inter / (self.union - self.inter) if self.union > 0 else None
+        inter, union = float(self.inter), float(self.union)
+        return inter / (union - inter) if union > 0 else None
 
 
 # Cell
+def _ngrams(x, n):
+    "All the `n`-grams of the sequence of token ids `x`, as the rows of an array"
+    x = np.asarray(x, dtype=np.int64)
+    if len(x) < n:
+        return np.empty((0, n), dtype=np.int64)
+    return sliding_window_view(x, n)
+
+
+def _clipped_matches(pred_ids, targ_ids):
+    "Number of ids of `pred_ids` in `targ_ids`, each clipped to its count there"
+    if len(pred_ids) == 0 or len(targ_ids) == 0:
+        return 0
+    pred_ids, pred_cnt = np.unique(pred_ids, return_counts=True)
+    targ_ids, targ_cnt = np.unique(targ_ids, return_counts=True)
+    _, pi, ti = np.intersect1d(
+        pred_ids, targ_ids, assume_unique=True, return_indices=True
+    )
+    return int(np.minimum(pred_cnt[pi], targ_cnt[ti]).sum())
+
+
+def _correct_ngrams(pred, targ, n, max_n=5000):
+    "Number of `n`-grams of `pred` in `targ` (clipped to their count there) and number of `n`-grams in `pred`"
+    pred_grams, targ_grams = _ngrams(pred, n), _ngrams(targ, n)
+    if len(pred_grams) == 0 or len(targ_grams) == 0:
+        return 0, len(pred_grams)
+    top = max(pred_grams.max(), targ_grams.max())
+    bot = min(pred_grams.min(), targ_grams.min())
+    # Negative ids (e.g. padding) would collide in base `max_n`
+    if bot >= 0 and top < max_n and max_n ** n < 2 ** 63:
+        # Each n-gram as one integer in base `max_n`
+        base = max_n ** np.arange(n, dtype=np.int64)
+        pred_ids, targ_ids = pred_grams @ base, targ_grams @ base
+    else:
+        _, ids = np.unique(
+            np.concatenate([pred_grams, targ_grams]), axis=0, return_inverse=True
+        )
+        pred_ids, targ_ids = ids[: len(pred_grams)], ids[len(pred_grams) :]
+    return _clipped_matches(pred_ids, targ_ids), len(pred_grams)
+
+
+def _ngram_pows(max_n, n_max=4):
+    "Powers of `max_n` hashing the n-grams up to `n_max` in int64, `None` if they would overflow"
+    if max_n ** n_max >= 2 ** 63:
+        return None
+    return np.array([max_n ** i for i in range(n_max)], dtype=np.int64)
+
+
+def _ngram_counts(pred, targ, max_n=5000, n_max=4, pows=None):
+    "Clipped matches and totals of the 1 to `n_max`-grams of `pred` in `targ`, as a `(n_max, 2)` array"
+    pred, targ = np.asarray(pred, dtype=np.int64), np.asarray(targ, dtype=np.int64)
+    res = np.zeros((n_max, 2), dtype=np.int64)
+    if pows is None:
+        pows = _ngram_pows(max_n, n_max)
+    top = max(pred.max(initial=0), targ.max(initial=0))
+    bot = min(pred.min(initial=0), targ.min(initial=0))
+    # Negative ids (e.g. padding) would collide in base `max_n`
+    if pows is None or top >= max_n or bot < 0:
+        for i in range(n_max):
+            res[i] = _correct_ngrams(pred, targ, i + 1, max_n=max_n)
+        return res
+    # The ids of the n-grams in base `max_n` are the ones of the (n-1)-grams plus the last token
+    pred_ids, targ_ids = pred, targ
+    for i in range(n_max):
+        if i > 0:
+            pred_ids = pred_ids[:-1] + pred[i:] * pows[i]
+            targ_ids = targ_ids[:-1] + targ[i:] * pows[i]
+        res[i] = _clipped_matches(pred_ids, targ_ids), len(pred_ids)
+    return res
+
+
+def _ngram_counts_batch(preds, targs, max_n=5000, n_max=4, pows=None):
+    "Clipped matches and totals of the 1 to `n_max`-grams of each row of `preds` in the same row of `targs`, as two `(bs, n_max)` arrays"
+    preds, targs = np.asarray(preds, dtype=np.int64), np.asarray(targs, dtype=np.int64)
+    bs = len(preds)
+    if pows is None:
+        pows = _ngram_pows(max_n, n_max)
+    top = max(preds.max(initial=0), targs.max(initial=0))
+    bot = min(preds.min(initial=0), targs.min(initial=0))
+    # Negative ids (e.g. padding) would collide in base `max_n`
+    if pows is None or top >= max_n or bot < 0 or bs * max_n ** n_max >= 2 ** 63:
+        res = np.zeros((bs, n_max, 2), dtype=np.int64)
+        for j, (pred, targ) in enumerate(zip(preds, targs)):
+            res[j] = _ngram_counts(pred, targ, max_n=max_n, n_max=n_max, pows=pows)
+        return res[..., 0], res[..., 1]
+    corrects, totals = np.zeros((2, bs, n_max), dtype=np.int64)
+    # Offsetting the ids of each row keeps the n-grams of different samples apart in one `np.unique`
+    row_sz = max_n ** n_max
+    offs = np.arange(bs, dtype=np.int64)[:, None] * row_sz
+    pred_ids, targ_ids = preds, targs
+    for i in range(n_max):
+        if i > 0:
+            pred_ids = pred_ids[:, :-1] + preds[:, i:] * pows[i]
+            targ_ids = targ_ids[:, :-1] + targs[:, i:] * pows[i]
+        totals[:, i] = pred_ids.shape[1]
+        p_ids, p_cnt = np.unique(pred_ids + offs, return_counts=True)
+        t_ids, t_cnt = np.unique(targ_ids + offs, return_counts=True)
+        ids, pi, ti = np.intersect1d(
+            p_ids, t_ids, assume_unique=True, return_indices=True
+        )
+        matches = np.minimum(p_cnt[pi], t_cnt[ti])
+        corrects[:, i] = np.bincount(ids // row_sz, weights=matches, minlength=bs)
+    return corrects, totals
+
+
 class CorpusBLEUMetric(Metric):
     def __init__(self, vocab_sz=5000, axis=-1):
         "BLEU Metric calculated over the validation corpus"
         self.metric_name = "CorpusBLEU"
         self.axis, self.vocab_sz = axis, vocab_sz
+        # `None` when the n-grams can't be hashed in int64, they're then compared with `np.unique`
+        self._pows = _ngram_pows(vocab_sz)
         self.pred_len, self.targ_len, self.samp_idx, self.corrects, self.counts, = (
             0,
             0,
@@ -793,40 +1139,36 @@ class CorpusBLEUMetric(Metric):
             return int(sum([o * self.max_n ** i for i, o in enumerate(self.ngram)]))
 
     def get_grams(self, x, n, max_n=5000):
+        "The `n`-grams of `x`, as `NGram`s for `n > 1` (kept for compatibility, `accumulate` uses `_ngrams`)"
         return (
             x
             if n == 1
-            else [self.NGram(x[i : i + n], max_n=max_n) for i in range(len(x) - n + 1)]
+            else [self.NGram(g, max_n=max_n) for g in _ngrams(x, n).tolist()]
         )
 
     def get_correct_ngrams(self, pred, targ, n, max_n=5000):
-        pred_grams, targ_grams = self.get_grams(pred, n, max_n=max_n), self.get_grams(
-            targ, n, max_n=max_n
-        )
-        pred_cnt, targ_cnt = Counter(pred_grams), Counter(targ_grams)
-        return sum([min(c, targ_cnt[g]) for g, c in pred_cnt.items()]), len(pred_grams)
+        "Number of `n`-grams of `pred` in `targ` (clipped to their count there) and number of `n`-grams in `pred`"
+        return _correct_ngrams(pred, targ, n, max_n=max_n)
 
     def accumulate(self, learn):
         if learn.training:
             return None
         else:
-            last_output = learn.pred.argmax(dim=self.axis)
-            last_target = learn.y
-            for pred, targ in zip(last_output.cpu().numpy(), last_target.cpu().numpy()):
-                self.pred_len += len(pred)
-                self.targ_len += len(targ)
-                smooth_mteval = 1
-                for i in range(4):
-                    c, t = self.get_correct_ngrams(
-                        pred, targ, i + 1, max_n=self.vocab_sz
-                    )
-                    if c == 0:
-                        smooth_mteval *= 2
-                        c = (
-                            1 / smooth_mteval
-                        )  # exp smoothing, method 3 from http://acl2014.org/acl2014/W14-33/pdf/W14-3346.pdf
-                    self.corrects[i] += c
-                    self.counts[i] += t
+            preds = learn.pred.argmax(dim=self.axis).cpu().numpy()
+            targs = learn.y.cpu().numpy()
+            self.pred_len += preds.size
+            self.targ_len += targs.size
+            corrects, counts = _ngram_counts_batch(
+                preds, targs, max_n=self.vocab_sz, pows=self._pows
+            )
+            # exp smoothing, method 3 from http://acl2014.org/acl2014/W14-33/pdf/W14-3346.pdf:
+            # the k-th n-gram size with no match in a sample counts 1/2**k
+            zeros = corrects == 0
+            corrects = np.where(zeros, 1 / 2.0 ** np.cumsum(zeros, axis=1), corrects)
+            self.corrects = [
+                c + o for c, o in zip(self.corrects, corrects.sum(0).tolist())
+            ]
+            self.counts = [c + o for c, o in zip(self.counts, counts.sum(0).tolist())]
 
     @property
     def value(self):
@@ -853,7 +1195,8 @@ class LossMetric(AvgMetric):
 
     def accumulate(self, learn):
         bs = find_bs(learn.yb)
-        self.total += learn.to_detach(getattr(learn.loss_func, self.attr, 0)) * bs
+        v = getattr(learn.loss_func, self.attr, 0)
+        self.total += learn.to_detach(v, cpu=False, gather=False) * bs
         self.count += bs
 
     @property
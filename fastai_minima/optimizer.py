@@ -27,11 +27,16 @@ __all__ = [
 # See the License for the specific language
 
 # Cell
+import math
+import sys
 from collections import defaultdict
+from collections.abc import MutableMapping
+from warnings import warn
+from weakref import ref
 
+import numpy as np
 import torch
 from fastcore.basics import GetAttr, even_mults, merge, range_of
-from fastcore.foundation import L
 from fastcore.meta import delegates
 from fastcore.xtras import is_listy
 from torch import optim
@@ -39,37 +44,63 @@ from torch import optim
 from .utils import tensor
 
 
+# Cell
+class _ParamGroupView(MutableMapping):
+    "Param group `i` of `opt` merging its `params` and hypers `hp` without building a new dict, writes go to `opt`"
+
+    def __init__(self, opt, i, params, hp):
+        self.opt, self.i, self.params, self.hp = opt, i, params, hp
+
+    def __getitem__(self, k):
+        return self.params if k == "params" else self.hp[k]
+
+    def __setitem__(self, k, v):
+        if k == "params":
+            self.params[:] = v
+        else:
+            self.opt._set_group_hyper(self.i, k, v)
+            self.hp[k] = v
+
+    def __delitem__(self, k):
+        raise TypeError(f"Can't remove {k!r} from a param group")
+
+    def __iter__(self):
+        yield "params"
+        yield from (k for k in self.hp if k != "params")
+
+    def __len__(self):
+        return len(self.hp) + ("params" not in self.hp)
+
+
 # Cell
 class _BaseOptimizer:
     "Common functionality between `Optimizer` and `OptimWrapper`"
 
     def all_params(self, n=slice(None), with_grad=False):
         "List of param_groups, paramters, and hypers"
-        res = L(
-            (p, pg, self.state[p], hyper)
+        state = self.state
+        return [
+            (p, pg, state[p], hyper)
             for pg, hyper in zip(self.param_lists[n], self.hypers[n])
             for p in pg
-        )
-        return (
-            L(o for o in res if hasattr(o[0], "grad") and o[0].grad is not None)
-            if with_grad
-            else res
-        )
-
-    def _set_require_grad(self, rg, p, pg, state, h):
-        p.requires_grad_(rg or state.get("force_train", False))
+            if not with_grad or p.grad is not None
+        ]
 
     def freeze_to(self, n):
         "Freeze parameter groups up to `n`"
-        self.frozen_idx = n if n >= 0 else len(self.param_lists) + n
-        if self.frozen_idx >= len(self.param_lists):
+        pls = self.param_lists
+        self.frozen_idx = n if n >= 0 else len(pls) + n
+        if self.frozen_idx >= len(pls):
             warn(
-                f"Freezing {self.frozen_idx} groups; model has {len(self.param_lists)}; whole model is frozen."
+                f"Freezing {self.frozen_idx} groups; model has {len(pls)}; whole model is frozen."
             )
-        for o in self.all_params(slice(n, None)):
-            self._set_require_grad(True, *o)
-        for o in self.all_params(slice(None, n)):
-            self._set_require_grad(False, *o)
+        # One pass over the parameters, without building `all_params` (and `hypers`) twice
+        for i, pg in enumerate(pls):
+            frozen = i < self.frozen_idx
+            for p in pg:
+                p.requires_grad_(
+                    not frozen or self.state.get(p, {}).get("force_train", False)
+                )
 
     def freeze(self):
         "Freeze up to last parameter group"
@@ -80,7 +111,11 @@ class _BaseOptimizer:
         "Set `rg` for parameter group `n` only"
         for p in self.param_lists[n]:
             p.requires_grad_(
-                rg or (state.get("force_train", False) and not ignore_force_train)
+                rg
+                or (
+                    self.state.get(p, {}).get("force_train", False)
+                    and not ignore_force_train
+                )
             )
 
     def unfreeze(self):
@@ -89,7 +124,8 @@ class _BaseOptimizer:
 
     def set_hypers(self, **kwargs):
         "Apply `set_hyper` for all `kwargs`"
-        L(kwargs.items()).starmap(self.set_hyper)
+        for k, v in kwargs.items():
+            self.set_hyper(k, v)
 
     def _set_hyper(self, k, v):
         for v_, h in zip(v, self.hypers):
@@ -97,23 +133,32 @@ class _BaseOptimizer:
 
     def set_hyper(self, k, v):
         "Set the value(s) in `v` for hyper-paramter `k`"
+        n_groups = len(self.param_lists)
+        if isinstance(v, np.ndarray) and v.ndim == 1 and len(v) == n_groups:
+            # Schedules evaluated on per-group arrays (e.g. `fit_one_cycle`) at each batch
+            return self._set_hyper(k, v.tolist())
         if isinstance(v, slice):
             if v.start:
-                v = even_mults(v.start, v.stop, len(self.param_lists))
+                v = even_mults(v.start, v.stop, n_groups)
             else:
-                v = [v.stop / 10] * (len(self.param_lists) - 1) + [v.stop]
-        v = L(v, use_list=None)
+                v = [v.stop / 10] * (n_groups - 1) + [v.stop]
+        is_vec = isinstance(v, (np.ndarray, torch.Tensor)) and v.ndim > 0
+        v = list(v) if is_listy(v) or is_vec else [v]
         if len(v) == 1:
-            v = v * len(self.param_lists)
-        assert len(v) == len(
-            self.hypers
-        ), f"Trying to set {len(v)} values for {k} but there are {len(self.param_lists)} parameter groups."
+            v = v * n_groups
+        assert (
+            len(v) == n_groups
+        ), f"Trying to set {len(v)} values for {k} but there are {n_groups} parameter groups."
         self._set_hyper(k, v)
 
+    def _set_group_hyper(self, i, k, v):
+        self.hypers[i][k] = v
+
     @property
     def param_groups(self):
         return [
-            {**{"params": pg}, **hp} for pg, hp in zip(self.param_lists, self.hypers)
+            _ParamGroupView(self, i, pg, hp)
+            for i, (pg, hp) in enumerate(zip(self.param_lists, self.hypers))
         ]
 
     @param_groups.setter
@@ -141,22 +186,33 @@ def detuplify_pg(d):
     for k, v in d.items():
         if k == "params":
             continue
-        if is_listy(v):
-            res.update(**{f"{k}__{i}": v_ for i, v_ in enumerate(v)})
+        if isinstance(v, (tuple, list)):
+            for i, v_ in enumerate(v):
+                res[f"{k}__{i}"] = v_
         else:
             res[k] = v
     return res
 
 
 # Cell
+def _set_pg_item(pg, name, idx, v):
+    "Set `pg[name]` to `v`, or only its element `idx` if not `None`"
+    if idx is None:
+        pg[name] = v
+        return
+    cur = pg[name]
+    if isinstance(cur, list):
+        cur[idx] = v
+    else:
+        pg[name] = cur[:idx] + (v,) + cur[idx + 1 :]
+
+
 def set_item_pg(pg, k, v):
     if "__" not in k:
         pg[k] = v
     else:
         name, idx = k.split("__")
-        pg[name] = tuple(
-            v if i == int(idx) else pg[name][i] for i in range_of(pg[name])
-        )
+        _set_pg_item(pg, name, int(idx), v)
     return pg
 
 
@@ -169,8 +225,57 @@ pytorch_hp_map = {
     "betas__1": "sqr_mom",
 }
 
+# Cell
+class _ParamState:
+    "State of each parameter, an empty dict at first, dropped when the parameter is garbage collected"
+
+    # Keyed by `id`: `WeakKeyDictionary` compares tensors with `==`, which is elementwise
+    def __init__(self):
+        self.d = {}
+
+    def _drop(self, k):
+        def _inner(r):
+            # Only if the entry still is the one of the collected parameter, its `id` can be reused
+            if self.d.get(k, (None,))[0] is r:
+                del self.d[k]
+
+        return _inner
+
+    def _find(self, p):
+        o = self.d.get(id(p))
+        return None if o is None or o[0]() is not p else o
+
+    def __getitem__(self, p):
+        o = self._find(p)
+        if o is None:
+            k = id(p)
+            o = self.d[k] = ref(p, self._drop(k)), {}
+        return o[1]
+
+    def get(self, p, default=None):
+        o = self._find(p)
+        return default if o is None else o[1]
+
+    def __contains__(self, p):
+        return self._find(p) is not None
+
+    def __len__(self):
+        return len(self.d)
+
+    # Weak references can't be pickled or copied: the parameters are, along with their state
+    def __getstate__(self):
+        return {"items": [(r(), st) for r, st in self.d.values() if r() is not None]}
+
+    def __setstate__(self, state):
+        self.d = {}
+        for p, st in state["items"]:
+            self.d[id(p)] = ref(p, self._drop(id(p))), st
+
+
 # Cell
 class OptimWrapper(_BaseOptimizer, GetAttr):
+    "Wraps the PyTorch optimizer `opt`, exposing its hyper-parameters with the names of `hp_map`"
+
     _xtra = ["zero_grad", "step", "state_dict", "load_state_dict"]
     _default = "opt"
 
@@ -178,24 +283,61 @@ class OptimWrapper(_BaseOptimizer, GetAttr):
         self.opt = opt
         if hp_map is None:
             hp_map = pytorch_hp_map
-        self.fwd_map = {
-            k: hp_map[k] if k in hp_map else k
-            for k in detuplify_pg(opt.param_groups[0]).keys()
-        }
+        # The keys of the groups are fixed: `_pg_schema` has `(key, hyper name)`, or `(key, names)`
+        # for tuple values, and `_bwd_keys` the `(key, index)` to set for each hyper name
+        self.fwd_map, self._bwd_keys, self._pg_schema = {}, {}, []
+        for k, v in opt.param_groups[0].items():
+            if k == "params":
+                continue
+            names = []
+            for i in range_of(v) if is_listy(v) else [None]:
+                # Interned, like the literal names callers index `hypers` with
+                key = k if i is None else sys.intern(f"{k}__{i}")
+                hp = self.fwd_map[key] = hp_map.get(key, key)
+                self._bwd_keys[hp] = (k, i)
+                names.append(hp)
+            self._pg_schema.append((k, names if is_listy(v) else names[0]))
         self.bwd_map = {v: k for k, v in self.fwd_map.items()}
-        self.state = defaultdict(dict, {})
+        self._all_scalar = not any(isinstance(n, list) for _, n in self._pg_schema)
+        self.state = _ParamState()
         self.frozen_idx = 0
 
     @property
     def hypers(self):
-        return [
-            {self.fwd_map[k]: v for k, v in detuplify_pg(pg).items() if k != "params"}
-            for pg in self.opt.param_groups
-        ]
+        # Rebuilt at each read (every batch), so values set directly in `opt.param_groups` are seen
+        return [self._detuplify(pg) for pg in self.opt.param_groups]
+
+    def _detuplify(self, pg):
+        "`detuplify_pg` with the keys mapped by `fwd_map`, using the precomputed schema"
+        if self._all_scalar:
+            # No tuple values (e.g. SGD): one comprehension
+            return {hp: pg[k] for k, hp in self._pg_schema}
+        res = {}
+        for k, names in self._pg_schema:
+            if isinstance(names, list):
+                res.update(zip(names, pg[k]))
+            else:
+                res[names] = pg[k]
+        return res
 
     def _set_hyper(self, k, v):
+        name, idx = self._bwd_keys[k]
         for pg, v_ in zip(self.opt.param_groups, v):
-            pg = set_item_pg(pg, self.bwd_map[k], v_)
+            _set_pg_item(pg, name, idx, v_)
+
+    def _set_group_hyper(self, i, k, v):
+        name, idx = self._bwd_keys.get(k, (k, None))
+        _set_pg_item(self.opt.param_groups[i], name, idx, v)
+
+    param_groups = property(_BaseOptimizer.param_groups.fget)
+
+    @param_groups.setter
+    def param_groups(self, v):
+        # `hypers` are copies: the values are set in `opt.param_groups`
+        for i, v_ in enumerate(v):
+            for k, t in v_.items():
+                if k != "params":
+                    self._set_group_hyper(i, k, t)
 
     def clear_state(self):
         self.opt.state = defaultdict(dict, {})
@@ -210,24 +352,98 @@ class OptimWrapper(_BaseOptimizer, GetAttr):
             pg["params"] = v_
 
 
+# Cell
+try:
+    from torch.optim import _multi_tensor
+except ImportError:
+    _multi_tensor = None
+
+
+def _optim_cls(name, foreach=False):
+    "`optim.{name}`, or its multi-tensor version (one `torch._foreach_*` kernel per op for all params) if `foreach`"
+    if foreach:
+        if _multi_tensor is not None:
+            return getattr(_multi_tensor, name)
+        warn(f"`foreach` needs `torch.optim._multi_tensor`, using `optim.{name}`")
+    return getattr(optim, name)
+
+
+# Cell
+class _LowPrecStateAdam(optim.Adam):
+    "`optim.Adam` storing `exp_avg` and `exp_avg_sq` in `state_dtype`, the update itself is computed in float32"
+
+    def __init__(self, params, state_dtype=torch.bfloat16, **kwargs):
+        super().__init__(params, **kwargs)
+        self.state_dtype = state_dtype
+        assert not any(
+            pg["amsgrad"] for pg in self.param_groups
+        ), "`amsgrad` is not supported with `state_dtype`"
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            beta1, beta2 = group["betas"]
+            for p in group["params"]:
+                if p.grad is None:
+                    continue
+                grad = p.grad.float()
+                if group["weight_decay"] != 0:
+                    grad = grad.add(p.float(), alpha=group["weight_decay"])
+                state = self.state[p]
+                if len(state) == 0:
+                    state["step"] = 0
+                    for k in ("exp_avg", "exp_avg_sq"):
+                        state[k] = torch.zeros_like(
+                            p,
+                            dtype=self.state_dtype,
+                            memory_format=torch.preserve_format,
+                        )
+                state["step"] += 1
+                # Copies, even when the state already is in float32
+                exp_avg = state["exp_avg"].to(torch.float32, copy=True)
+                exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+                exp_avg_sq = state["exp_avg_sq"].to(torch.float32, copy=True)
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                state["exp_avg"].copy_(exp_avg)
+                state["exp_avg_sq"].copy_(exp_avg_sq)
+                bias_correction1 = 1 - beta1 ** state["step"]
+                bias_correction2 = 1 - beta2 ** state["step"]
+                denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(
+                    group["eps"]
+                )
+                step_size = group["lr"] / bias_correction1
+                p.sub_((exp_avg / denom).mul_(step_size).to(p.dtype))
+        return loss
+
+
 # Cell
 @delegates(optim.Adam)
-def Adam(params, **kwargs):
+def Adam(params, foreach=False, state_dtype=None, **kwargs):
     "Convience function to make an Adam optimizer compatable with `Learner`"
-    return OptimWrapper(optim.Adam(params, **kwargs))
+    if state_dtype is not None:
+        if foreach:
+            warn("`foreach` is ignored when `state_dtype` is set")
+        return OptimWrapper(
+            _LowPrecStateAdam(params, state_dtype=state_dtype, **kwargs)
+        )
+    return OptimWrapper(_optim_cls("Adam", foreach)(params, **kwargs))
 
 
 # Cell
 @delegates(optim.SGD)
-def SGD(params, **kwargs):
+def SGD(params, foreach=False, **kwargs):
     "Convience function to make a SGD optimizer compatable with `Learner`"
-    return OptimWrapper(optim.SGD(params, **kwargs))
+    return OptimWrapper(_optim_cls("SGD", foreach)(params, **kwargs))
 
 
 # Cell
 def params(m):
     "Return all parameters of `m`"
-    return [p for p in m.parameters()]
+    return list(m.parameters())
 
 
 # Cell
@@ -254,11 +470,13 @@ def convert_params(o: list) -> list:
       def forward(self, x): return x*self.a + self.b
     ```
     """
-    if not isinstance(o[0], dict):
-        splitter = []
-        for group in o:
-            if not isinstance(group[0], nn.parameter.Parameter):
-                group = L(group).map(params)
-            splitter.append({"params": group})
-        return splitter
-    return o
+    if isinstance(o[0], dict):
+        return o
+    return [
+        {
+            "params": g
+            if isinstance(g[0], nn.Parameter)
+            else [p for m in g for p in m.parameters()]
+        }
+        for g in o
+    ]
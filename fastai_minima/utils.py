@@ -13,14 +13,17 @@
 # See the License for the specific language
 
 import os
+import queue
 import sys
+import threading
+from collections import deque
 from types import SimpleNamespace
 from typing import Generator, Iterable
 
 import numpy as np
 import pandas as pd
 import torch
-from fastcore.basics import patch, range_of
+from fastcore.basics import GetAttr, patch, range_of, store_attr
 from fastcore.dispatch import retain_type
 from fastcore.foundation import L
 from fastcore.meta import use_kwargs_dict
@@ -70,6 +73,127 @@ def to_device(b, device=None):
     return apply(_inner, b)
 
 
+def _on_device(ts, device):
+    "Whether all of `ts` are tensors on `device`"
+    device = torch.device(device)
+    if device.type == "cuda" and device.index is None:
+        device = torch.device("cuda", torch.cuda.current_device())
+    return all(isinstance(t, Tensor) and t.device == device for t in ts)
+
+
+def _record_stream(o, stream):
+    "Mark `o` as used on `stream`, so its memory isn't reused before that stream is done with it"
+    if isinstance(o, Tensor) and o.is_cuda:
+        o.record_stream(stream)
+    return o
+
+
+# Tensors at most that big are packed together to be copied with one transfer
+_coalesce_max_bytes = 2 ** 20
+
+
+def _coalesced_to_device(b, device):
+    "Move `b` to `device`, with one copy per dtype for all its small CPU tensors if it's a tuple or list of tensors"
+    if not isinstance(b, (tuple, list)) or not all(
+        isinstance(t, Tensor) and t.device.type == "cpu" for t in b
+    ):
+        return to_device(b, device)
+    res, groups, pin = list(b), {}, torch.device(device).type == "cuda"
+    for i, t in enumerate(b):
+        if t.numel() * t.element_size() <= _coalesce_max_bytes:
+            groups.setdefault(t.dtype, []).append(i)
+    for idxs in groups.values():
+        if len(idxs) < 2:
+            continue
+        sizes = [b[i].numel() for i in idxs]
+        buf = torch.empty(sum(sizes), dtype=b[idxs[0]].dtype, pin_memory=pin)
+        torch.cat([b[i].reshape(-1) for i in idxs], out=buf)
+        flat = buf.to(device, non_blocking=True)
+        for i, o in zip(idxs, flat.split(sizes)):
+            res[i] = o.view(b[i].shape)
+    return type(b)(o.to(device, non_blocking=True) for o in res)
+
+
+class _Prefetcher(GetAttr):
+    "Iterate over `dl` with its batches moved to `device` up to `n` batches ahead, from a background thread if `thread`"
+    _default = "dl"
+
+    def __init__(self, dl, device, n=1, thread=False):
+        store_attr()
+
+    def __len__(self):
+        return len(self.dl)
+
+    def _copies(self):
+        "The batches of `dl` on `device`, with the CUDA event marking the end of their copy (or `None`)"
+        device = torch.device(self.device)
+        if device.type != "cuda" or defaults.use_cuda == False:
+            yield from ((to_device(b, device), None) for b in self.dl)
+            return
+        # Copies are queued on a side stream (asynchronous if the batch is in pinned memory)
+        stream = torch.cuda.Stream(device)
+        for b in self.dl:
+            with torch.cuda.stream(stream):
+                b = _coalesced_to_device(b, device)
+                ev = stream.record_event()
+            yield b, ev
+
+    def _ready(self, b, ev):
+        "Make the current stream wait for the copy of `b` and own its memory"
+        if ev is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(ev)
+            apply(_record_stream, b, stream)
+        return b
+
+    def _fill(self, q, stop):
+        def _put(o):
+            while not stop.is_set():
+                try:
+                    return q.put(o, timeout=0.1)
+                except queue.Full:
+                    pass
+
+        try:
+            for o in self._copies():
+                _put(o)
+                # The consumer stopped early (e.g. a `CancelFitException`)
+                if stop.is_set():
+                    return
+        except Exception as e:
+            _put((e, None))
+        _put((_Prefetcher, None))
+
+    def _iter_thread(self):
+        q, stop = queue.Queue(maxsize=self.n), threading.Event()
+        t = threading.Thread(target=self._fill, args=(q, stop), daemon=True)
+        t.start()
+        try:
+            while True:
+                b, ev = q.get()
+                if b is _Prefetcher:
+                    return
+                if isinstance(b, Exception):
+                    raise b
+                yield self._ready(b, ev)
+        finally:
+            stop.set()
+            t.join()
+
+    def __iter__(self):
+        if self.thread:
+            yield from self._iter_thread()
+            return
+        # The copies of the next `n` batches are queued before the current one is used
+        pending = deque()
+        for o in self._copies():
+            pending.append(o)
+            if len(pending) > self.n:
+                yield self._ready(*pending.popleft())
+        while pending:
+            yield self._ready(*pending.popleft())
+
+
 def to_concat(xs, dim=0):
     "Concat the element in `xs` (recursively if they are tuples/lists of tensors)"
     if not xs:
@@ -85,24 +209,16 @@ def to_concat(xs, dim=0):
     try:
         return retain_type(torch.cat(xs, dim=dim), xs[0])
     except Exception:
-        return sum(
-            [
-                L(
-                    retain_type(o_.index_select(dim, tensor(i)).squeeze(dim), xs[0])
-                    for i in range_of(o_)
-                )
-                for o_ in xs
-            ],
-            L(),
-        )
+        return L(retain_type(row, xs[0]) for o_ in xs for row in o_.unbind(dim))
 
 
 def maybe_gather(x, axis=0):
     "Gather copies of `x` on `axis` (if training is distributed)"
-    if num_distrib() <= 1:
+    n = num_distrib()
+    if n <= 1:
         return x
     ndim = x.ndim
-    res = [x.new_zeros(*x.shape if ndim > 0 else (1,)) for _ in range(num_distrib())]
+    res = [x.new_zeros(*x.shape if ndim > 0 else (1,)) for _ in range(n)]
     torch.distributed.all_gather(res, x.contiguous() if ndim > 0 else x[None])
     return torch.cat(res, dim=axis) if ndim > 0 else torch.cat(res, dim=axis).mean()
 
@@ -141,6 +257,11 @@ def to_half(b):
     return apply(lambda x: x.half() if torch.is_floating_point(x) else x, b)
 
 
+def to_float(b):
+    "Recursively map lists of tensors in `b` to float."
+    return apply(lambda x: x.float() if torch.is_floating_point(x) else x, b)
+
+
 def distrib_barrier():
     "Place a synchronization barrier in distributed training"
     if num_distrib() > 1 and torch.distributed.is_initialized():
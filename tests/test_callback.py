@@ -0,0 +1,212 @@
+import warnings
+from types import SimpleNamespace
+
+import pytest
+import torch
+from fastcore.basics import patch
+from torch import nn
+from torch.utils.data import DataLoader, TensorDataset
+
+from fastai_minima.callback.core import Callback, CancelStepException, _Gather
+from fastai_minima.callback.training_utils import ChannelsLast, MixedPrecision
+from fastai_minima.learner import DataLoaders, Learner
+from fastai_minima.utils import _Prefetcher
+
+
+class _Counter(Callback):
+    def __init__(self):
+        self.calls = []
+
+    def before_fit(self):
+        self.calls.append("before_fit")
+
+    def before_batch(self):
+        self.calls.append("before_batch")
+
+
+def test_dispatch_defined_event():
+    cb = _Counter()
+    cb("before_fit")
+    cb("before_batch")
+    assert cb.calls == ["before_fit", "before_batch"]
+
+
+def test_dispatch_undefined_event():
+    assert _Counter()("after_epoch") is None
+
+
+def test_dispatch_run_false():
+    cb = _Counter()
+    cb.run = False
+    cb("before_fit")
+    assert cb.calls == []
+    cb("after_fit")
+    assert cb.run
+
+
+def test_dispatch_run_train():
+    cb = _Counter()
+    cb.run_train = False
+    cb.training = True
+    cb("before_batch")
+    cb("before_fit")
+    assert cb.calls == ["before_fit"]
+
+
+def test_dispatch_patched_event():
+    class _Patched(Callback):
+        pass
+
+    cb = _Patched()
+    cb.calls = []
+
+    @patch
+    def after_epoch(self: _Patched):
+        self.calls.append("after_epoch")
+
+    cb("after_epoch")
+    assert cb.calls == ["after_epoch"]
+
+    @patch
+    def after_epoch(self: _Patched):
+        self.calls.append("patched again")
+
+    cb("after_epoch")
+    assert cb.calls == ["after_epoch", "patched again"]
+
+
+def test_dispatch_passed_event():
+    calls = []
+    cb = Callback(before_batch=lambda self: calls.append(self))
+    cb("before_batch")
+    assert calls == [cb]
+
+
+def test_gather_prealloc():
+    g = _Gather(5)
+    g.append((torch.arange(3), torch.ones(3, 2)))
+    g.append((torch.arange(3, 5), torch.zeros(2, 2)))
+    assert not g.items
+    x, y = g.concat()
+    assert torch.equal(x, torch.arange(5))
+    assert torch.equal(y, torch.cat([torch.ones(3, 2), torch.zeros(2, 2)]))
+
+
+def test_gather_fallback():
+    g = _Gather(4)
+    g.append(torch.ones(2, 3))
+    g.append(torch.zeros(2, 4))
+    assert g.concat(dim=1).shape == (2, 7)
+    g = _Gather(3)
+    g.append(torch.arange(2))
+    g.append(torch.arange(2))
+    assert torch.equal(g.concat(), torch.tensor([0, 1, 0, 1]))
+
+
+class _CountingDL:
+    def __init__(self, n):
+        self.n, self.loaded = n, 0
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        for i in range(self.n):
+            self.loaded += 1
+            yield torch.tensor([i])
+
+
+def test_prefetcher_early_stop():
+    dl = _CountingDL(1000)
+    it = iter(_Prefetcher(dl, "cpu", n=2, thread=True))
+    assert torch.equal(next(it), torch.tensor([0]))
+    it.close()
+    # The loading thread stops instead of going through the rest of `dl`
+    assert dl.loaded < 10
+
+
+def test_prefetcher_order():
+    for thread in (False, True):
+        res = list(_Prefetcher(_CountingDL(5), "cpu", thread=thread))
+        assert [int(o) for o in res] == list(range(5))
+
+
+def test_mixed_precision_exits_autocast():
+    cb = MixedPrecision()
+    cb("before_fit")
+    cb("before_batch")
+    assert cb._in_autocast
+    # Batch cancelled before the loss: `after_loss` never runs
+    cb("after_cancel_batch")
+    cb("after_batch")
+    assert not cb._in_autocast
+    cb("before_batch")
+    cb("after_loss")
+    assert not cb._in_autocast
+    cb("after_fit")
+    assert cb.autocast is None
+
+
+def test_to_fp16_to_fp32():
+    ds = TensorDataset(torch.randn(4, 2), torch.randn(4, 1))
+    dls = DataLoaders(DataLoader(ds, batch_size=2), DataLoader(ds, batch_size=2))
+    learn = Learner(dls, nn.Linear(2, 1), loss_func=nn.MSELoss())
+    learn.to_fp16(init_scale=2.0 ** 8)
+    cb = learn.mixed_precision
+    assert isinstance(cb, MixedPrecision) and cb in learn.cbs
+    assert cb.kwargs == {"init_scale": 2.0 ** 8}
+    learn.to_fp32()
+    assert not hasattr(learn, "mixed_precision") and cb not in learn.cbs
+
+
+def _mixed_precision_step(grad):
+    p = nn.Parameter(torch.zeros(2, device=grad.device))
+    cb = MixedPrecision()
+    cb.learn = SimpleNamespace(opt=SimpleNamespace(param_groups=[{"params": [p]}]))
+    cb.before_fit()
+    cb.learn.loss_grad = p.sum()
+    cb.before_backward()
+    p.grad = grad
+    cb.before_step()
+
+
+def test_mixed_precision_step():
+    # Without CUDA the `GradScaler` is disabled and always steps
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    _mixed_precision_step(torch.ones(2, device=device))
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="`GradScaler` needs CUDA")
+def test_mixed_precision_skips_inf_step():
+    with pytest.raises(CancelStepException):
+        _mixed_precision_step(torch.tensor([1.0, float("inf")], device="cuda"))
+
+
+def test_shadowing_warns_once():
+    class _Shadowing(Callback):
+        pass
+
+    cb = _Shadowing()
+    cb.learn = SimpleNamespace(lr=1e-3)
+    with pytest.warns(UserWarning, match="shadowing"):
+        cb.lr = 1e-2
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        cb.lr = 1e-1
+    # Checked again for another learner
+    cb.learn = SimpleNamespace(lr=1e-3)
+    with pytest.warns(UserWarning, match="shadowing"):
+        cb.lr = 1e-2
+
+
+def test_channels_last():
+    cb, cl = ChannelsLast(), torch.channels_last
+    x4, x2 = torch.randn(2, 3, 4, 4), torch.randn(2, 3)
+    cb.learn = SimpleNamespace(model=nn.Conv2d(3, 4, 3), xb=(x4, x2, "meta"))
+    cb.before_fit()
+    assert cb.learn.model.weight.is_contiguous(memory_format=cl)
+    cb.before_batch()
+    xb = cb.learn.xb
+    assert isinstance(xb, tuple) and len(xb) == 3
+    assert xb[0].is_contiguous(memory_format=cl) and torch.equal(xb[0], x4)
+    assert xb[1] is x2 and xb[2] == "meta"
@@ -0,0 +1,37 @@
+import torch
+from torch.utils.data import DataLoader, SequentialSampler, TensorDataset
+
+from fastai_minima.learner import DataLoaders
+
+
+def _collate(b):
+    return torch.stack([o[0] for o in b]) * 2
+
+
+def _init_worker(i):
+    pass
+
+
+def test_make_persistent():
+    ds = TensorDataset(torch.arange(10.0))
+    sampler = SequentialSampler(ds)
+    dl = DataLoader(
+        ds,
+        batch_size=3,
+        sampler=sampler,
+        collate_fn=_collate,
+        num_workers=1,
+        drop_last=True,
+        timeout=30,
+        worker_init_fn=_init_worker,
+    )
+    dl0 = DataLoader(ds, batch_size=3)
+    dls = DataLoaders(dl, dl0).make_persistent()
+    new = dls.train
+    assert new is not dl and new.persistent_workers and not dl.persistent_workers
+    assert new.sampler is sampler and new.collate_fn is _collate
+    assert (new.num_workers, new.batch_size, new.drop_last) == (1, 3, True)
+    assert (new.timeout, new.worker_init_fn) == (30, _init_worker)
+    assert all(torch.equal(a, b) for a, b in zip(new, dl)) and len(list(new)) == 3
+    # Without workers there is nothing to keep alive
+    assert dls.valid is dl0
@@ -0,0 +1,133 @@
+from collections import Counter
+from functools import partial
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import sklearn.metrics as skm
+import torch
+
+from fastai_minima.metrics import (
+    AccumMetric,
+    ActivationType,
+    DiceMulti,
+    RocAuc,
+    RocAucBinary,
+    _correct_ngrams,
+    _ngram_counts,
+    _ngram_counts_batch,
+    _Rows,
+    accuracy,
+    accuracy_multi,
+    flatten_check,
+)
+from fastai_minima.utils import to_detach
+
+
+def test_rows_grow():
+    r = _Rows()
+    for i in range(5):
+        r.append(torch.arange(3 * i, 3 * i + 3))
+    assert len(r) == 5 and not r.items
+    assert torch.equal(r.cat(), torch.arange(15))
+
+
+def test_rows_fallback():
+    r = _Rows()
+    r.append(torch.ones(2, 3))
+    r.append(torch.zeros(1, 3, dtype=torch.long))
+    r.append(torch.ones(2, 3))
+    assert [t.dtype for t in r.items] == [torch.float, torch.long, torch.float]
+    assert [len(t) for t in r.items] == [2, 1, 2]
+
+
+def test_accum_metric():
+    m = AccumMetric(accuracy, flatten=False)
+    m.reset()
+    preds, targs = torch.randn(10, 4), torch.randint(0, 4, (10,))
+    m.accum_values(preds[:6], targs[:6])
+    m.accum_values(preds[6:], targs[6:])
+    assert torch.allclose(m.value, accuracy(preds, targs))
+
+
+def test_dice_multi():
+    preds = torch.randn(2, 3, 4, 4)
+    targs = torch.randint(0, 3, (2, 4, 4))
+    pred = preds.argmax(dim=1)
+    scores = []
+    for c in range(3):
+        p, t = pred == c, targs == c
+        union = (p.sum() + t.sum()).item()
+        scores.append(2.0 * (p & t).sum().item() / union if union > 0 else np.nan)
+    # Masks loaded as floats give the same result
+    for y in (targs, targs.float()):
+        m = DiceMulti()
+        m.reset()
+        for p, t in zip(preds, y):
+            m.accumulate(SimpleNamespace(pred=p[None], y=t[None]))
+        assert np.isclose(m.value, np.nanmean(scores))
+
+
+def test_accum_metric_defer_activation():
+    preds, targs = torch.randn(10, 4), torch.randint(0, 2, (10, 4))
+    res = []
+    for defer in (False, True):
+        m = AccumMetric(
+            partial(accuracy_multi, sigmoid=False, thresh=0.5),
+            activation=ActivationType.Sigmoid,
+            thresh=0.5,
+            defer_activation=defer,
+        )
+        m.reset()
+        for p, t in zip(preds.split(3), targs.split(3)):
+            m.accumulate(SimpleNamespace(pred=p, y=t, to_detach=to_detach))
+        res.append(m.value)
+    assert torch.equal(*res)
+
+
+def test_bucketed_roc_auc():
+    preds, targs = torch.randn(200, 3), torch.randint(0, 3, (200,))
+    for metric, binary in ((RocAuc, False), (RocAucBinary, True)):
+        p = preds[:, :2] if binary else preds
+        t = targs.clamp(max=1) if binary else targs
+        m = metric(n_buckets=10000)
+        m.reset()
+        for pb, tb in zip(p.split(64), t.split(64)):
+            m.accumulate(SimpleNamespace(pred=pb, y=tb))
+        probs = p.softmax(-1).numpy()
+        exact = skm.roc_auc_score(
+            t.numpy(), probs[:, 1] if binary else probs, multi_class="ovr"
+        )
+        assert abs(m.value - exact) < 1e-2
+
+
+def test_ngram_counts_batch():
+    def _ref(pred, targ, n):
+        grams = lambda x: [tuple(x[i : i + n]) for i in range(len(x) - n + 1)]
+        pred_cnt, targ_cnt = Counter(grams(pred)), Counter(grams(targ))
+        return sum(min(c, targ_cnt[g]) for g, c in pred_cnt.items()), len(grams(pred))
+
+    rng = np.random.default_rng(0)
+    preds, targs = rng.integers(-2, 6, (8, 12)), rng.integers(-2, 6, (8, 12))
+    # A `max_n` below the largest token takes the per-sample fallback
+    for max_n in (10, 3):
+        corrects, totals = _ngram_counts_batch(preds, targs, max_n=max_n)
+        for j, (pred, targ) in enumerate(zip(preds.tolist(), targs.tolist())):
+            for n in range(1, 5):
+                assert (corrects[j, n - 1], totals[j, n - 1]) == _ref(pred, targ, n)
+
+
+def test_flatten_check():
+    inp, targ = flatten_check(torch.zeros(2, 3), torch.zeros(6))
+    assert inp.shape == targ.shape == (6,)
+    with pytest.raises(ValueError):
+        flatten_check(torch.zeros(2, 3), torch.zeros(5))
+
+
+def test_ngram_negative_ids():
+    # In base 5000, `(-1, 1)` and `(4999, 0)` are the same number
+    pred, targ = [-1, 1], [4999, 0]
+    assert _correct_ngrams(pred, targ, 2) == (0, 1)
+    assert _ngram_counts(pred, targ, n_max=2).tolist() == [[0, 2], [0, 1]]
+    corrects, totals = _ngram_counts_batch([pred], [targ], n_max=2)
+    assert corrects.tolist() == [[0, 0]] and totals.tolist() == [[2, 1]]
@@ -0,0 +1,105 @@
+import copy
+import gc
+import pickle
+from weakref import ref
+
+import pytest
+import torch
+from torch import nn, optim
+
+import fastai_minima.optimizer as fm_optim
+from fastai_minima.optimizer import SGD, Adam, _multi_tensor, _ParamState
+
+
+def test_hypers_follow_set_hyper():
+    opt = Adam(nn.Linear(2, 2).parameters(), lr=1e-3)
+    assert opt.hypers[0]["lr"] == 1e-3
+    opt.set_hyper("lr", 1e-2)
+    opt.set_hyper("mom", 0.8)
+    assert opt.hypers[0]["lr"] == 1e-2 and opt.hypers[0]["mom"] == 0.8
+    assert opt.opt.param_groups[0]["betas"] == (0.8, 0.999)
+
+
+def test_hypers_after_load_state_dict():
+    opt = Adam(nn.Linear(2, 2).parameters(), lr=1e-3)
+    sd = opt.state_dict()
+    opt.set_hyper("lr", 1e-2)
+    opt.load_state_dict(sd)
+    assert opt.hypers[0]["lr"] == 1e-3
+
+
+def test_hypers_follow_param_groups():
+    opt = Adam(nn.Linear(2, 2).parameters(), lr=1e-3)
+    assert opt.hypers[0]["lr"] == 1e-3
+    opt.opt.param_groups[0]["lr"] = 1e-2
+    opt.opt.param_groups[0]["betas"] = (0.8, 0.99)
+    assert opt.hypers[0]["lr"] == 1e-2
+    assert opt.hypers[0]["mom"] == 0.8 and opt.hypers[0]["sqr_mom"] == 0.99
+
+
+def test_param_groups_write_through():
+    opt = Adam(nn.Linear(2, 2).parameters(), lr=1e-3)
+    pg = opt.param_groups[0]
+    pg["lr"], pg["mom"] = 1e-2, 0.8
+    assert opt.hypers[0]["lr"] == 1e-2 and opt.param_groups[0]["mom"] == 0.8
+    assert opt.opt.param_groups[0]["betas"] == (0.8, 0.999)
+
+
+def _adam_steps(opt, p, n=5):
+    for i in range(n):
+        p.grad = torch.sin(p.detach() * (i + 1))
+        opt.step()
+    return p.detach().clone()
+
+
+def test_low_prec_state_adam():
+    p0 = torch.randn(4, 3)
+    p_ref = nn.Parameter(p0.clone())
+    ref = _adam_steps(optim.Adam([p_ref], lr=1e-2, weight_decay=0.1), p_ref)
+    for state_dtype, atol in ((torch.float32, 1e-6), (torch.bfloat16, 1e-3)):
+        p = nn.Parameter(p0.clone())
+        opt = Adam([p], lr=1e-2, weight_decay=0.1, state_dtype=state_dtype)
+        assert torch.allclose(_adam_steps(opt, p), ref, atol=atol)
+        assert opt.opt.state[p]["exp_avg"].dtype == state_dtype
+
+
+def test_param_state_dropped():
+    st, p = _ParamState(), nn.Parameter(torch.zeros(2))
+    st[p]["do_wd"] = False
+    assert p in st and st.get(p) == {"do_wd": False}
+    k, r = id(p), st.d[id(p)][0]
+    # The callback of a collected parameter leaves the entry of one reusing its `id`
+    q = nn.Parameter(torch.zeros(2))
+    st.d[k] = ref(q), {"force_train": True}
+    st._drop(k)(r)
+    assert st.d[k][1] == {"force_train": True}
+    st = _ParamState()
+    st[p]["do_wd"] = False
+    del p
+    gc.collect()
+    assert len(st) == 0
+
+
+def test_optim_wrapper_copy():
+    m = nn.Linear(2, 2)
+    opt = Adam(m.parameters(), lr=1e-3)
+    opt.state[m.weight]["do_wd"] = False
+    for o in (copy.deepcopy((m, opt)), pickle.loads(pickle.dumps((m, opt)))):
+        m2, opt2 = o
+        assert opt2.state[m2.weight] == {"do_wd": False}
+        assert opt2.hypers[0]["lr"] == 1e-3
+
+
+@pytest.mark.skipif(_multi_tensor is None, reason="no `torch.optim._multi_tensor`")
+def test_foreach():
+    ps = list(nn.Linear(2, 2).parameters())
+    assert type(Adam(ps, foreach=True).opt) is _multi_tensor.Adam
+    assert type(SGD(ps, lr=0.1, foreach=True).opt) is _multi_tensor.SGD
+    assert type(Adam(ps).opt) is optim.Adam
+
+
+def test_foreach_missing_warns(monkeypatch):
+    monkeypatch.setattr(fm_optim, "_multi_tensor", None)
+    with pytest.warns(UserWarning):
+        opt = Adam(list(nn.Linear(2, 2).parameters()), foreach=True)
+    assert type(opt.opt) is optim.Adam
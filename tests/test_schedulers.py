@@ -0,0 +1,98 @@
+import math
+from functools import partial
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from hypothesis import given
+from hypothesis.strategies import floats, integers
+
+from fastai_minima.callback.training import (
+    LRFinder,
+    SchedCos,
+    SchedLin,
+    combine_scheds,
+    combined_cos,
+    sched_cos,
+    sched_exp,
+)
+
+
+def test_combine_scheds():
+    f = combine_scheds([0.3, 0.7], [SchedLin(0.0, 1.0), SchedLin(1.0, 0.0)])
+    assert f(0.0) == 0.0
+    assert f(0.15) == pytest.approx(0.5)
+    assert f(0.3) == pytest.approx(1.0)
+    assert f(0.65) == pytest.approx(0.5)
+    assert f(1.0) == 0.0
+
+
+def test_combine_scheds_empty_segment():
+    f = combine_scheds([0.0, 1.0], [SchedLin(5.0, 5.0), SchedLin(0.0, 1.0)])
+    assert f(0.0) == 0.0
+    assert f(0.5) == pytest.approx(0.5)
+
+
+def test_combine_scheds_cos():
+    f = combine_scheds([0.25, 0.75], [SchedCos(1.0, 2.0), SchedCos(2.0, 0.0)])
+    assert f(0.125) == pytest.approx(1.5)
+    assert f(0.25) == pytest.approx(2.0)
+    assert f(0.625) == pytest.approx(1 + math.cos(math.pi / 2))
+
+
+@given(
+    floats(0.01, 0.99),
+    floats(-10, 10),
+    floats(-10, 10),
+    floats(-10, 10),
+    floats(0, 1),
+)
+def test_combined_cos(pct, start, middle, end, pos):
+    # The exact cosines (`SchedCos` interpolates them from a table)
+    cos1, cos2 = partial(sched_cos, start, middle), partial(sched_cos, middle, end)
+    ref = combine_scheds([pct, 1 - pct], [cos1, cos2])
+    f = combined_cos(pct, start, middle, end)
+    for p in (pos, 0.0, pct, 1.0):
+        assert f(p) == pytest.approx(ref(p), abs=1e-9)
+
+
+def test_combined_cos_arrays():
+    start, middle, end = np.array([1e-4, 1e-3]), np.array([1e-3, 1e-2]), 0.0
+    cos1, cos2 = partial(sched_cos, start, middle), partial(sched_cos, middle, end)
+    ref = combine_scheds([0.25, 0.75], [cos1, cos2])
+    f = combined_cos(0.25, start, middle, end)
+    for p in np.linspace(0, 1, 11):
+        np.testing.assert_allclose(f(p), ref(p), atol=1e-12)
+
+
+class _HyperLog:
+    def __init__(self):
+        self.lrs = []
+
+    def set_hyper(self, k, v):
+        self.lrs.append(v)
+
+
+@given(floats(1e-8, 1e-3), floats(1e-2, 10), integers(1, 200))
+def test_lr_finder_schedule(start_lr, end_lr, num_it):
+    for listy in (False, True):
+        starts, ends = [start_lr, start_lr * 10], [end_lr, end_lr / 10]
+        lrs = (starts, ends) if listy else (start_lr, end_lr)
+        cb = LRFinder(*lrs, num_it)
+        learn = SimpleNamespace(
+            dls=SimpleNamespace(train=range(num_it)),
+            n_epoch=1,
+            opt=_HyperLog(),
+            save=lambda *args: None,
+        )
+        cb.learn = learn
+        cb.before_fit()
+        for i in range(num_it + 1):
+            learn.train_iter = i
+            cb.before_batch()
+            # Same as the per-batch `SchedExp` values
+            if listy:
+                ref = [sched_exp(s, e, i / num_it) for s, e in zip(starts, ends)]
+            else:
+                ref = sched_exp(start_lr, end_lr, i / num_it)
+            np.testing.assert_allclose(learn.opt.lrs[-1], ref, rtol=1e-10)
@@ -1,10 +1,10 @@
 import numpy as np
 import torch
 from hypothesis import given
-from hypothesis.strategies import floats
+from hypothesis.strategies import booleans, floats, integers, lists, sampled_from, tuples
 from hypothesis_gufunc.gufunc import gufunc_args
 
-from fastai_minima.utils import to_concat
+from fastai_minima.utils import _coalesced_to_device, to_concat
 
 
 def torchify(args):
@@ -45,3 +45,28 @@ def test_concat_second_dim(x):
 
 def test_concat_none():
     assert to_concat(None) is None
+
+
+_dtypes = [torch.float32, torch.float16, torch.int64, torch.uint8, torch.bool]
+
+
+@given(
+    lists(tuples(sampled_from(_dtypes), lists(integers(0, 5), max_size=3)), max_size=6),
+    booleans(),
+)
+def test_coalesced_to_device(specs, as_tuple):
+    b = [torch.arange(int(np.prod(sh))).reshape(sh).to(dt) for dt, sh in specs]
+    b = tuple(b) if as_tuple else b
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    res = _coalesced_to_device(b, device)
+    assert type(res) is type(b) and len(res) == len(b)
+    for o, t in zip(res, b):
+        assert o.device.type == device and o.dtype == t.dtype and o.shape == t.shape
+        assert torch.equal(o.cpu(), t)
+
+
+def test_coalesced_to_device_large():
+    # Tensors over `_coalesce_max_bytes` are copied on their own
+    b = (torch.randn(600, 600), torch.arange(3), torch.arange(4).float(), torch.ones(2))
+    res = _coalesced_to_device(b, "cpu")
+    assert all(torch.equal(o, t) for o, t in zip(res, b))